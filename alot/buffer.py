@@ -17,14 +17,16 @@ along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
 Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
 """
 import urwid
-from notmuch.globals import NotmuchError
 
 
 import widgets
 import settings
 import command
 from walker import IteratorWalker
+from walker import PagingWalker
+from walker import ThreadWalker
 from message import decode_header
+from db import DatabaseQueryError
 
 
 class Buffer:
@@ -157,18 +159,22 @@ class SearchBuffer(Buffer):
             focusposition = 0
             self.isinitialized = True
 
-        self.result_count = self.dbman.count_messages(self.querystring)
         try:
-            self.tids = self.dbman.search_thread_ids(self.querystring)
-        except NotmuchError:
+            self.result_count = self.dbman.count_messages(self.querystring)
+            result = self.dbman.get_result_index(self.querystring)
+            self.threadlist = PagingWalker(result, widgets.ThreadlineWidget,
+                                           dbman=self.dbman)
+            self.threadlist.get_focus()  # fetches the first page
+        except DatabaseQueryError:
             self.ui.notify('malformed query string: %s' % self.querystring,
                            'error')
-            self.tids = []
-        self.threadlist = IteratorWalker(iter(self.tids),
-                                         widgets.ThreadlineWidget,
-                                         dbman=self.dbman)
+            self.result_count = 0
+            self.threadlist = IteratorWalker(iter([]),
+                                             widgets.ThreadlineWidget,
+                                             dbman=self.dbman)
+        if focusposition:  # random access, so keep focus on rebuild
+            self.threadlist.set_focus(focusposition)
         self.listbox = urwid.ListBox(self.threadlist)
-        #self.threadlist.set_focus(focusposition)
         self.body = self.listbox
 
     def debug(self):
@@ -200,39 +206,11 @@ class ThreadBuffer(Buffer):
     def get_selected_thread(self):
         return self.thread
 
-    def _build_pile(self, acc, msg, parent, depth):
-        acc.append((parent, depth, msg))
-        for reply in self.thread.get_replies_to(msg):
-            self._build_pile(acc, reply, msg, depth + 1)
-
     def rebuild(self):
-        # depth-first traversing the thread-tree, thereby
-        # 1) build a list of tuples (parentmsg, depth, message) in DF order
-        # 2) create a dict that counts no. of direct replies per message
-        messages = list()  # accumulator for 1,
-        childcount = {None: 0}  # accumulator for 2)
-        for msg, replies in self.thread.get_messages().items():
-            childcount[msg] = len(replies)
-        # start with all toplevel msgs, then recursively call _build_pile
-        for msg in self.thread.get_toplevel_messages():
-            self._build_pile(messages, msg, None, 0)
-            childcount[None] += 1
-
-        # go through list from 1) and pile up message widgets for all msgs.
-        # each one will be given its depth, if siblings follow and where to
-        # draw bars (siblings follow at lower depths)
-        msglines = list()
-        bars = []
-        for (num, (p, depth, m)) in enumerate(messages):
-            bars = bars[:depth]
-            childcount[p] -= 1
-
-            bars.append(childcount[p] > 0)
-            mwidget = widgets.MessageWidget(m, even=(num % 2 == 0),
-                                            depth=depth,
-                                            bars_at=bars)
-            msglines.append(mwidget)
-        self.body = urwid.ListBox(msglines)
+        # message widgets are created by the walker as they scroll into view
+        self.messagewalker = ThreadWalker(self.thread.get_thread_tree(),
+                                          widgets.MessageWidget)
+        self.body = urwid.ListBox(self.messagewalker)
 
     def get_selection(self):
         (messagewidget, size) = self.body.get_focus()
@@ -243,23 +221,23 @@ class ThreadBuffer(Buffer):
         return messagewidget.get_message()
 
     def get_message_widgets(self):
-        return self.body.body.contents
+        return self.messagewalker.get_lines()
 
     def get_focus(self):
         return self.body.get_focus()
 
     def unfold_matching(self, querystring):
-        for mw in self.get_message_widgets():
-            msg = mw.get_message()
-            if msg.matches(querystring):
-                mw.fold(visible=True)
+        """unfolds the messages of this thread that match querystring"""
+        tid = self.thread.get_thread_id()
+        matching = self.ui.dbman.search_message_ids(
+            '(%s) AND thread:%s' % (querystring, tid))
+        for pos, msg in enumerate(self.messagewalker.tree.messages):
+            if msg.get_message_id() in matching:
+                self.messagewalker.unfold(pos)
                 if 'unread' in msg.get_tags():
                     msg.remove_tags(['unread'])
                     self.ui.apply_command(command.FlushCommand())
 
-    def get_message_widgets(self):
-        return self.body.body.contents
-
 
 class TagListBuffer(Buffer):
     def __init__(self, ui, alltags=[], filtfun=None):
@@ -282,7 +260,7 @@ class TagListBuffer(Buffer):
         displayedtags = filter(self.filtfun, self.tags)
         for (num, b) in enumerate(displayedtags):
             tw = widgets.TagWidget(b)
-            lines.append(urwid.Columns([('fixed', tw.len(), tw)]))
+            lines.append(urwid.Columns([('fixed', tw.width(), tw)]))
         self.taglist = urwid.ListBox(urwid.SimpleListWalker(lines))
         self.body = self.taglist
 
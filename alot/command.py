@@ -69,6 +69,11 @@ class ExitCommand(Command):
             if not ui.choice('realy quit?', choices={'yes': ['y', 'enter'],
                                                      'no': ['n']}) == 'yes':
                 return
+        # give the flush worker a chance to commit pending writes
+        if ui.dbman.writequeue:
+            ui.flushworker.wakeup()
+            timeout = settings.config.getint('general', 'flush_retry_timeout')
+            ui.flushworker.idle.wait(timeout)
         raise urwid.ExitMainLoop()
 
 
@@ -131,6 +136,7 @@ class PromptCommand(Command):
 class RefreshCommand(Command):
     """refreshes the current buffer"""
     def apply(self, ui):
+        ui.dbman.reopen()
         ui.current_buffer.rebuild()
         ui.update()
 
@@ -283,19 +289,18 @@ class TagListCommand(Command):
 
 
 class FlushCommand(Command):
-    """Flushes writes to the index. Retries until committed"""
-    def apply(self, ui):
-        try:
-            ui.dbman.flush()
-        except DatabaseLockedError:
-            timeout = settings.config.getint('general', 'flush_retry_timeout')
+    """Flushes writes to the index in the background. Retries until
+    committed"""
+    def __init__(self, callback=None, **kwargs):
+        """
+        :param callback: called once all pending writes are committed
+        :type callback: callable
+        """
+        self.callback = callback
+        Command.__init__(self, **kwargs)
 
-            def f(*args):
-                self.apply(ui)
-            ui.mainloop.set_alarm_in(timeout, f)
-            ui.notify('index locked, will try again in %d secs' % timeout)
-            ui.update()
-            return
+    def apply(self, ui):
+        ui.flush(callback=self.callback)
 
 
 class ToggleThreadTagCommand(Command):
@@ -320,27 +325,29 @@ class ToggleThreadTagCommand(Command):
             ui.notify('index in read-only mode', priority='error')
             return
 
-        # flush index
-        ui.apply_command(FlushCommand())
-
         # update current buffer
-        # TODO: what if changes not yet flushed?
         cb = ui.current_buffer
         if isinstance(cb, buffer.SearchBuffer):
             # refresh selected threadline
             threadwidget = cb.get_selected_threadline()
             threadwidget.rebuild()  # rebuild and redraw the line
+
             #remove line from searchlist if thread doesn't match the query
-            qs = "(%s) AND thread:%s" % (cb.querystring,
-                                         self.thread.get_thread_id())
-            msg_count = ui.dbman.count_messages(qs)
-            if ui.dbman.count_messages(qs) == 0:
-                ui.logger.debug('remove: %s' % self.thread)
-                cb.threadlist.remove(threadwidget)
-                cb.result_count -= self.thread.get_total_messages()
-                ui.update()
-        elif isinstance(cb, buffer.ThreadBuffer):
-            pass
+            def remove_unmatched():
+                if threadwidget not in cb.threadlist.get_lines():
+                    return  # buffer has been rebuilt in the meantime
+                qs = "(%s) AND thread:%s" % (cb.querystring,
+                                             self.thread.get_thread_id())
+                if ui.dbman.count_messages(qs) == 0:
+                    ui.logger.debug('remove: %s' % self.thread)
+                    cb.threadlist.remove(threadwidget)
+                    cb.result_count -= self.thread.get_total_messages()
+                    ui.update()
+            # flush index, the count is only meaningful after the write
+            ui.apply_command(FlushCommand(callback=remove_unmatched))
+        else:
+            # flush index
+            ui.apply_command(FlushCommand())
 
 
 class ComposeCommand(Command):
@@ -19,12 +19,34 @@ Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
 from notmuch import Database, NotmuchError
 from datetime import datetime
 from collections import deque
+from collections import OrderedDict
+from array import array
+import os
+import sys
+import threading
+import logging
+import time
+import re
 
 from message import Message
+from helper import intern_tags
+from snippet import get_snippet_index
 from settings import notmuchconfig as config
 
 DB_ENC = 'utf-8'
 
+# number of messages written per atomic transaction in DBManager.flush
+FLUSH_BATCH_SIZE = 1000
+
+# number of distinct query strings whose counts are cached
+COUNT_CACHE_SIZE = 256
+
+# number of thread ids collected at once when paging through results
+PAGE_CHUNK_SIZE = 500
+
+# matches query strings whose result depends on the tags of messages
+TAG_QUERY_PATTERN = re.compile(r'\b(tag|is):')
+
 
 class DatabaseError(Exception):
     pass
@@ -38,57 +60,370 @@ class DatabaseLockedError(DatabaseError):
     pass
 
 
+class DatabaseQueryError(DatabaseError):
+    pass
+
+
+class TagDelta:
+    """
+    the net effect of a sequence of queued tag operations on one message.
+    """
+    def __init__(self):
+        self.replace = False  # if set, all tags not in add are removed
+        self.add = set()
+        self.remove = set()
+        self.sync = False
+
+    def update(self, cmd, tags, sync=False):
+        """merges a queued operation into this delta
+
+        :param cmd: one of 'tag', 'untag' or 'set'
+        :type cmd: str
+        :param tags: the tags of the operation
+        :type tags: list of str
+        :param sync: synchronize maildir flags for this message
+        :type sync: boolean
+        """
+        tags = set([decode_tag(t) for t in tags])
+        if cmd == 'tag':
+            self.add |= tags
+            self.remove -= tags
+        elif cmd == 'set':
+            self.replace = True
+            self.add = tags
+            self.remove = set()
+        elif cmd == 'untag':
+            self.add -= tags
+            self.remove |= tags
+        self.sync = self.sync or sync
+
+    def resolve(self, current):
+        """returns the pair (tags to add, tags to remove) that need to be
+        written for a message that currently has the given tags"""
+        current = set([decode_tag(t) for t in current])
+        if self.replace:
+            return self.add - current, current - self.add
+        return self.add - current, self.remove & current
+
+
+def normalize_query(querystring):
+    """returns querystring with normalized whitespace, for use as cache key"""
+    return ' '.join(querystring.split())
+
+
+def decode_tag(tag):
+    """returns tag as unicode string"""
+    if isinstance(tag, unicode):
+        return tag
+    return tag.decode(DB_ENC)
+
+
+class DatabasePool:
+    """
+    hands out long-lived read-only :class:`notmuch.Database` handles.
+
+    Opening the index is expensive, so handles are kept around and reused.
+    Each thread gets its own handle since the bindings are not thread-safe.
+    A read-only handle only sees the revision of the index that was current
+    when it was opened, so all handles are reopened lazily after
+    :meth:`invalidate` has been called.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: absolute path to the notmuch index
+        :type path: str
+        """
+        self.path = path
+        self.opens = 0
+        self.reuses = 0
+        self.reopens = 0
+        self._generation = 0
+        self._handles = {}  # maps thread ids to (generation, db) pairs
+        self._lock = threading.Lock()
+
+    def get(self):
+        """returns a read-only :class:`notmuch.Database` for this thread"""
+        key = threading.current_thread().ident
+        with self._lock:
+            generation = self._generation
+            entry = self._handles.get(key)
+        if entry is not None:
+            if entry[0] == generation:
+                self.reuses += 1
+                return entry[1]
+            self.reopens += 1
+        else:
+            self.opens += 1
+        db = Database(path=self.path, mode=Database.MODE.READ_ONLY)
+        with self._lock:
+            self._handles[key] = (generation, db)
+        return db
+
+    def invalidate(self):
+        """marks all handles as outdated so they are reopened on next use"""
+        with self._lock:
+            self._generation += 1
+
+    def get_stats(self):
+        """returns a dict with counters for opens, reuses and reopens"""
+        return {'opens': self.opens, 'reuses': self.reuses,
+                'reopens': self.reopens}
+
+
+class Backend:
+    """
+    interface to the mail index used by :class:`DBManager`.
+
+    Threads and messages handed out by a backend must provide the accessors
+    of :class:`notmuch.Thread` and :class:`notmuch.Message` that
+    :class:`Thread` and :class:`alot.message.Message` rely on.
+    """
+    def search_threads(self, querystring):
+        """returns an iterator over all threads that match querystring,
+        newest first
+
+        :exception: :exc:`DatabaseQueryError` if querystring is malformed
+        """
+        raise NotImplementedError
+
+    def count_messages(self, querystring):
+        """returns number of messages that match querystring"""
+        raise NotImplementedError
+
+    def search_message_ids(self, querystring):
+        """returns the ids of all messages that match querystring as a set
+
+        :exception: :exc:`DatabaseQueryError` if querystring is malformed
+        """
+        raise NotImplementedError
+
+    def get_thread(self, tid):
+        """returns the thread with given id or None"""
+        raise NotImplementedError
+
+    def find_message(self, mid):
+        """returns the message with given id or None"""
+        raise NotImplementedError
+
+    def get_all_tags(self):
+        """returns all tags as list of strings"""
+        raise NotImplementedError
+
+    def open_writer(self):
+        """returns an object to write tags with. It must provide
+        `message_ids(querystring)`, which sees all previous writes,
+        `write(deltas, progress)` to commit a dict of :class:`TagDelta`
+        objects keyed by message id, and `close()`.
+
+        :exception: :exc:`DatabaseLockedError` if the index is locked
+        """
+        raise NotImplementedError
+
+    def reopen(self):
+        """called after writes, lookups must see them from now on"""
+        pass
+
+
+class NotmuchBackend(Backend):
+    """a notmuch index, read through pooled :class:`notmuch.Database`
+    handles"""
+    def __init__(self, path=None):
+        """
+        :param path: absolute path to the notmuch index
+        :type path: str
+        """
+        self.path = path
+        self.pool = DatabasePool(path)
+
+    def query(self, querystring):
+        """returns a :class:`notmuch.Query` for querystring"""
+        return self.pool.get().create_query(querystring)
+
+    def search_threads(self, querystring):
+        try:
+            return self.query(querystring).search_threads()
+        except NotmuchError:
+            raise DatabaseQueryError(querystring)
+
+    def count_messages(self, querystring):
+        return self.query(querystring).count_messages()
+
+    def search_message_ids(self, querystring):
+        try:
+            messages = self.query(querystring).search_messages()
+            return set(msg.get_message_id() for msg in messages)
+        except NotmuchError:
+            raise DatabaseQueryError(querystring)
+
+    def get_thread(self, tid):
+        #TODO raise exceptions here in 0<case msgcount>1
+        try:
+            return self.query('thread:' + tid).search_threads().next()
+        except:
+            return None
+
+    def find_message(self, mid):
+        return self.pool.get().find_message(mid)
+
+    def get_all_tags(self):
+        return [t for t in self.pool.get().get_all_tags()]
+
+    def open_writer(self):
+        try:
+            mode = Database.MODE.READ_WRITE
+            db = Database(path=self.path, mode=mode)
+        except NotmuchError:
+            raise DatabaseLockedError()
+        return NotmuchWriter(db)
+
+    def reopen(self):
+        # read handles don't see the new revision unless reopened
+        self.pool.invalidate()
+
+
+class NotmuchWriter:
+    """writes tags to a notmuch index opened in read-write mode"""
+    def __init__(self, db):
+        """
+        :param db: index opened in read-write mode
+        :type db: notmuch.Database
+        """
+        self.db = db
+
+    def message_ids(self, querystring):
+        """returns the ids of all messages that match querystring"""
+        query = self.db.create_query(querystring)
+        return [msg.get_message_id() for msg in query.search_messages()]
+
+    def write(self, deltas, progress=None):
+        """writes tag deltas, batched in atomic transactions of
+        :data:`FLUSH_BATCH_SIZE` messages
+
+        :param deltas: maps message ids to their net changes
+        :type deltas: dict of str -> :class:`TagDelta`
+        :param progress: called with the number of written and the total
+                         number of messages after each batch
+        :type progress: callable
+        """
+        db = self.db
+        # atomic sections are only available in notmuch >= 0.9
+        atomic = hasattr(db, 'begin_atomic')
+        mids = deltas.keys()
+        for start in xrange(0, len(mids), FLUSH_BATCH_SIZE):
+            if atomic:
+                db.begin_atomic()
+            for mid in mids[start:start + FLUSH_BATCH_SIZE]:
+                msg = db.find_message(mid)
+                if msg is None:
+                    continue
+                delta = deltas[mid]
+                add, remove = delta.resolve(msg.get_tags())
+                if not (add or remove):
+                    continue
+                msg.freeze()
+                for tag in remove:
+                    msg.remove_tag(tag.encode(DB_ENC))
+                for tag in add:
+                    msg.add_tag(tag.encode(DB_ENC))
+                msg.thaw()
+                if delta.sync:
+                    msg.tags_to_maildir_flags()
+            if atomic:
+                db.end_atomic()
+            if progress:
+                progress(min(start + FLUSH_BATCH_SIZE, len(mids)), len(mids))
+
+    def close(self):
+        """releases the write lock"""
+        # the bindings close the index once the last reference is gone
+        self.db = None
+
+
 class DBManager:
     """
-    keeps track of your index parameters, can create notmuch.Query
-    objects from its Database on demand and implements a bunch of
-    database specific functions.
+    keeps track of your index parameters, queues writes and implements a
+    bunch of database specific functions on top of a :class:`Backend`.
     """
-    def __init__(self, path=None, ro=False):
+    def __init__(self, path=None, ro=False, query_cache_size=16,
+                 backend=None):
         """
         :param path: absolute path to the notmuch index
         :type path: str
         :param ro: open the index in read-only mode
         :type ro: boolean
+        :param query_cache_size: memory budget in megabytes for cached
+                                 search results
+        :type query_cache_size: int
+        :param backend: the index to use, defaults to the notmuch index
+                        at path
+        :type backend: :class:`Backend`
         """
         self.ro = ro
         self.path = path
+        if backend is None:
+            backend = NotmuchBackend(path)
+        self.backend = backend
         self.writequeue = deque([])
+        self.writelock = threading.Lock()
+        # bumped whenever the index may have changed
+        self.generation = 0
+        self._counts = {}
+        self._counts_generation = 0
+        self.count_hits = 0
+        self.count_misses = 0
+        self.results = QueryResultCache(query_cache_size * 1024 * 1024)
 
-    def flush(self):
+    def flush(self, progress=None):
         """
         tries to flush all queued write commands to the index.
 
+        Queued operations are first merged into one net :class:`TagDelta`
+        per affected message, which the backend then writes in atomic
+        batches. Entries are only removed from the queue once they are
+        committed.
+
+        :param progress: called with the number of written and the total
+                         number of messages after each batch
+        :type progress: callable
         :exception: :exc:`DatabaseROError` if db is opened in read-only mode
         :exception: :exc:`DatabaseLockedError` if db is locked
         """
         if self.ro:
             raise DatabaseROError()
         if self.writequeue:
+            writer = self.backend.open_writer()
             try:
-                mode = Database.MODE.READ_WRITE
-                db = Database(path=self.path, mode=mode)
-            except NotmuchError:
-                raise DatabaseLockedError()
-            while self.writequeue:
-                cmd, querystring, tags, sync = self.writequeue.popleft()
-                query = db.create_query(querystring)
-                for msg in query.search_messages():
-                    msg.freeze()
-                    if cmd == 'tag':
-                        for tag in tags:
-                            msg.add_tag(tag.encode(DB_ENC),
-                                        sync_maildir_flags=sync)
-                    if cmd == 'set':
-                        msg.remove_all_tags()
-                        for tag in tags:
-                            msg.add_tag(tag.encode(DB_ENC),
-                                        sync_maildir_flags=sync)
-                    elif cmd == 'untag':
-                        for tag in tags:
-                            msg.remove_tag(tag.encode(DB_ENC),
-                                          sync_maildir_flags=sync)
-                    msg.thaw()
+                with self.writelock:
+                    entries = list(self.writequeue)
+                deltas = {}  # maps message ids to TagDelta objects
+                for cmd, querystring, tags, sync in entries:
+                    # queries that look at tags must see all earlier writes
+                    if deltas and TAG_QUERY_PATTERN.search(querystring):
+                        writer.write(deltas, progress)
+                        deltas = {}
+                    for mid in writer.message_ids(querystring):
+                        if mid not in deltas:
+                            deltas[mid] = TagDelta()
+                        deltas[mid].update(cmd, tags, sync)
+                writer.write(deltas, progress)
+            finally:
+                # releases the write lock of the index
+                writer.close()
+            with self.writelock:
+                for entry in entries:
+                    self.writequeue.popleft()
+            self._new_generation()
+
+    def reopen(self):
+        """makes subsequent lookups see the current state of the index.
+        Use this to pick up changes made by other processes."""
+        self._new_generation()
+
+    def _new_generation(self):
+        """invalidates everything that was read from the index so far"""
+        self.backend.reopen()
+        with self.writelock:
+            self.generation += 1
 
     def tag(self, querystring, tags, remove_rest=False):
         """
@@ -107,10 +442,11 @@ class DBManager:
             raise DatabaseROError()
         sync_maildir_flags = config.getboolean('maildir', 'synchronize_flags')
         if remove_rest:
-            self.writequeue.append(('set', querystring, tags,
-                                    sync_maildir_flags))
+            cmd = 'set'
         else:
-            self.writequeue.append(('tag', querystring, tags,
+            cmd = 'tag'
+        with self.writelock:
+            self.writequeue.append((cmd, querystring, tags,
                                     sync_maildir_flags))
 
     def untag(self, querystring, tags):
@@ -127,54 +463,447 @@ class DBManager:
         if self.ro:
             raise DatabaseROError()
         sync_maildir_flags = config.getboolean('maildir', 'synchronize_flags')
-        self.writequeue.append(('untag', querystring, tags,
-                                sync_maildir_flags))
+        with self.writelock:
+            self.writequeue.append(('untag', querystring, tags,
+                                    sync_maildir_flags))
 
     def count_messages(self, querystring):
-        """returns number of messages that match querystring"""
-        return self.query(querystring).count_messages()
+        """returns number of messages that match querystring.
+
+        Results are cached until the next write to the index.
+        """
+        generation = self.generation
+        if self._counts_generation != generation:
+            self._counts = {}
+            self._counts_generation = generation
+        key = normalize_query(querystring)
+        if key in self._counts:
+            self.count_hits += 1
+            return self._counts[key]
+        self.count_misses += 1
+        count = self.backend.count_messages(querystring)
+        # don't store counts that may predate a concurrent flush
+        if generation == self.generation:
+            if len(self._counts) >= COUNT_CACHE_SIZE:
+                self._counts = {}
+            self._counts[key] = count
+        return count
+
+    def search_message_ids(self, querystring):
+        """returns the ids of all messages that match querystring as a set
+
+        :exception: :exc:`DatabaseQueryError` if the query string is
+                    malformed
+        """
+        return self.backend.search_message_ids(querystring)
+
+    def get_count_stats(self):
+        """returns a dict with hit and miss counters of the count cache"""
+        return {'hits': self.count_hits, 'misses': self.count_misses,
+                'size': len(self._counts), 'generation': self.generation}
+
+    def get_result_index(self, querystring):
+        """returns the :class:`ResultIndex` for a query. It is shared with
+        other lookups of the same query until the next write to the index,
+        and keeps its positions afterwards.
+
+        :exception: :exc:`DatabaseQueryError` if the query string is
+                    malformed
+        """
+        self.results.set_generation(self.generation)
+        key = normalize_query(querystring)
+        index = self.results.get(key)
+        if index is None:
+            index = ResultIndex(self, querystring)
+            self.results.put(key, index)
+        return index
 
-    def search_thread_ids(self, querystring):
-        """returns the ids of all threads that match the querystring
-        This copies! all integer thread ids into an new list."""
-        threads = self.query(querystring).search_threads()
-        return [thread.get_thread_id() for thread in threads]
+    def get_threads_window(self, querystring, offset, limit):
+        """returns the threads at positions `offset` to `offset + limit`
+        in the result of a query.
+
+        Thread ids and summaries are kept in :attr:`results` until the next
+        write, so windows that were seen before need no query at all.
+
+        :param querystring: notmuch search string
+        :type querystring: str
+        :param offset: position of the first thread
+        :type offset: int
+        :param limit: maximal number of threads to return
+        :type limit: int
+        :returns: list of :class:`Thread`, with None at the positions of
+                  threads that no longer match
+        :exception: :exc:`DatabaseQueryError` if the query string is
+                    malformed
+        """
+        return self.get_result_index(querystring).get_threads(offset, limit)
+
+    def count_threads(self, querystring):
+        """returns number of threads that match querystring"""
+        return len(self.get_result_index(querystring))
 
     def get_thread(self, tid):
         """returns the thread with given id as alot.db.Thread object"""
-        query = self.query('thread:' + tid)
-        #TODO raise exceptions here in 0<case msgcount>1
-        try:
-            return Thread(self, query.search_threads().next())
-        except:
+        thread = self.backend.get_thread(tid)
+        if thread is None:
             return None
+        return Thread(self, thread)
 
     def get_message(self, mid):
         """returns the message with given id as alot.message.Message object"""
-        mode = Database.MODE.READ_ONLY
-        db = Database(path=self.path, mode=mode)
-        msg = db.find_message(mid)
+        msg = self.backend.find_message(mid)
         return Message(self, msg)
 
     def get_all_tags(self):
         """returns all tags as list of strings"""
-        db = Database(path=self.path)
-        return [t for t in db.get_all_tags()]
+        return self.backend.get_all_tags()
 
     def query(self, querystring):
-        """creates notmuch.Query objects on demand
+        """creates notmuch.Query objects on demand. Only available if the
+        notmuch backend is used.
 
         :param querystring: The query string to use for the lookup
         :type query: str.
         :returns:  notmuch.Query -- the query object.
 
         """
-        mode = Database.MODE.READ_ONLY
-        db = Database(path=self.path, mode=mode)
-        return db.create_query(querystring)
+        return self.backend.query(querystring)
+
+
+class FlushWorker(threading.Thread):
+    """
+    writer thread that drains the write queue of a :class:`DBManager`.
+
+    While the index is locked, flushing is retried with exponentially
+    growing delays. The worker reports back by writing newline terminated
+    status lines to a file descriptor, usually one obtained from
+    :meth:`urwid.MainLoop.watch_pipe`:
+
+    * `progress <written> <total>` after each committed batch
+    * `locked <secs>` when the index was locked
+    * `done` when the queue has been committed
+    * `error <message>` when flushing failed for other reasons
+    """
+    def __init__(self, dbman, report_fd, timeout=5, max_timeout=60):
+        """
+        :param dbman: db manager whose write queue is flushed
+        :type dbman: :class:`DBManager`
+        :param report_fd: file descriptor to write status lines to
+        :type report_fd: int
+        :param timeout: initial delay in secs between attempts
+        :type timeout: int
+        :param max_timeout: upper bound for the delay in secs
+        :type max_timeout: int
+        """
+        threading.Thread.__init__(self, name='flush')
+        self.daemon = True
+        self.dbman = dbman
+        self.report_fd = report_fd
+        self.timeout = max(timeout, 1)
+        self.max_timeout = max(max_timeout, self.timeout)
+        self.idle = threading.Event()
+        self.idle.set()
+        self._wakeup = threading.Event()
+
+    def wakeup(self):
+        """asks the worker to flush the current write queue"""
+        self.idle.clear()
+        self._wakeup.set()
+
+    def _report(self, line):
+        os.write(self.report_fd, line + '\n')
+
+    def _progress(self, written, total):
+        self._report('progress %d %d' % (written, total))
+
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            delay = self.timeout
+            while self.dbman.writequeue:
+                try:
+                    self.dbman.flush(progress=self._progress)
+                except DatabaseLockedError:
+                    sys.exc_clear()
+                    self._report('locked %d' % delay)
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_timeout)
+                except DatabaseROError:
+                    self._report('error index in read-only mode')
+                    break
+                except Exception, e:
+                    logging.exception('flushing failed')
+                    self._report('error %s' % e)
+                    # the traceback would keep the writer's database alive
+                    # while this thread waits for the next wakeup
+                    sys.exc_clear()
+                    break
+                else:
+                    self._report('done')
+            if not self._wakeup.is_set():
+                self.idle.set()
+
+
+class ResultIndex:
+    """
+    thread ids and summaries of a query result, read lazily in chunks of
+    :data:`PAGE_CHUNK_SIZE` from a single query.
+
+    The ids are a snapshot: a position keeps naming the same thread after
+    writes to the index. After a write the summaries are read again from a
+    new query, which also appends threads that were not known before.
+    """
+    def __init__(self, dbman, querystring):
+        """
+        :param dbman: db manager used for the lookups
+        :type dbman: :class:`DBManager`
+        :param querystring: notmuch search string
+        :type querystring: str
+        :exception: :exc:`DatabaseQueryError` if the query string is
+                    malformed
+        """
+        self._dbman = dbman
+        self.querystring = querystring
+        self.key = normalize_query(querystring)
+        self.generation = dbman.generation
+        self._threads = dbman.backend.search_threads(querystring)
+        self._known = None  # ids that were read before the last write
+        self.tids = []
+        self.threads = {}  # maps thread ids to summaries
+        self.complete = False
+        self.size = sys.getsizeof(self)  # estimated memory use in bytes
+        self._summaries_size = 0
+
+    def __len__(self):
+        self._update()
+        self._collect(None)
+        return len(self.tids)
+
+    def _update(self):
+        """catches up with writes to the index since the threads were read"""
+        generation = self._dbman.generation
+        if generation == self.generation:
+            return
+        self.generation = generation
+        self.threads = {}
+        self.size -= self._summaries_size
+        self._summaries_size = 0
+        self._threads = self._dbman.backend.search_threads(self.querystring)
+        self._known = set(self.tids)
+        self.complete = False
+
+    def _read_chunk(self):
+        """reads the next :data:`PAGE_CHUNK_SIZE` threads of the result and
+        keeps their summaries"""
+        for i in xrange(PAGE_CHUNK_SIZE):
+            try:
+                thread = self._threads.next()
+            except StopIteration:
+                if self._known is not None:  # threads that no longer exist
+                    for tid in self._known:
+                        if tid not in self.threads:
+                            self.add_thread(None, tid)
+                self.complete = True
+                self._threads = None
+                self._known = None
+                break
+            tid = thread.get_thread_id()
+            if self._known is None or tid not in self._known:
+                self.tids.append(tid)
+                # the string plus a pointer in the list
+                self.size += sys.getsizeof(tid) + 8
+            self.add_thread(Thread(self._dbman, thread))
+        self._dbman.results.account(self.key)
+
+    def _collect(self, count):
+        """reads threads until at least `count` ids are known or the result
+        is exhausted. `None` reads all."""
+        while not self.complete and (count is None or len(self.tids) < count):
+            self._read_chunk()
 
+    def get_ids(self, offset, limit):
+        """returns up to `limit` thread ids starting at position `offset`"""
+        self._update()
+        self._collect(offset + limit)
+        return self.tids[offset:offset + limit]
+
+    def get_threads(self, offset, limit):
+        """
+        returns the threads at positions `offset` to `offset + limit`.
+        The returned threads are copies, so that messages looked up for
+        them later do not grow the summaries that are kept, whose size is
+        only estimated once.
+
+        :returns: list of :class:`Thread`, with None at the positions of
+                  threads that no longer exist
+        """
+        tids = self.get_ids(offset, limit)
+        # after a write, summaries are read again as far as needed
+        missing = [tid for tid in tids if tid not in self.threads]
+        while missing and not self.complete:
+            self._read_chunk()
+            missing = [tid for tid in missing if tid not in self.threads]
+        return [self.threads[tid] and self.threads[tid].copy()
+                for tid in tids]
+
+    def add_thread(self, thread, tid=None):
+        """stores a thread summary, None marks a vanished thread `tid`"""
+        size = 2 * 8  # dict slot
+        if thread is not None:
+            tid = thread.get_thread_id()
+            size += estimate_size(thread)
+        self.threads[tid] = thread
+        self.size += size
+        self._summaries_size += size
+
+
+class QueryResultCache:
+    """
+    least recently used cache of :class:`ResultIndex` objects, keyed by
+    normalized query string. It is bounded by the estimated memory use
+    of the entries and emptied whenever the index generation changes.
+    """
+    def __init__(self, budget):
+        """
+        :param budget: maximal estimated size of all entries in bytes
+        :type budget: int
+        """
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._generation = 0
+        self._entries = OrderedDict()  # maps keys to (index, size) pairs
+
+    def set_generation(self, generation):
+        """drops all entries if generation differs from the last one"""
+        if generation != self._generation:
+            self._entries.clear()
+            self.size = 0
+            self._generation = generation
+
+    def get(self, key):
+        """returns the entry for key and marks it as recently used"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, index):
+        """adds an entry, evicting others if the budget is exceeded"""
+        self._entries[key] = (index, 0)
+        self.account(key)
+
+    def account(self, key):
+        """updates the recorded size of the entry for key, which may have
+        grown since it was added, and evicts least recently used entries
+        until the budget is met"""
+        if key not in self._entries:
+            return
+        index, recorded = self._entries[key]
+        self._entries[key] = (index, index.size)
+        self.size += index.size - recorded
+        while self.size > self.budget and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            if oldest == key:
+                break
+            index, recorded = self._entries.pop(oldest)
+            self.size -= recorded
+            self.evictions += 1
+
+    def get_stats(self):
+        """returns a dict with hit, miss and eviction counters as well as
+        the number of entries and their estimated size in bytes"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._entries),
+                'size': self.size, 'budget': self.budget}
+
+
+def estimate_size(thread):
+    """returns the estimated memory use of a :class:`Thread` in bytes"""
+    size = sys.getsizeof(thread)
+    for name in Thread.__slots__:
+        if name != '_dbman':  # shared by all threads
+            size += sys.getsizeof(getattr(thread, name))
+    return size
+
+
+class ThreadTree:
+    """
+    compact representation of the reply structure of a thread.
+
+    Messages are stored in depth-first order. For the message at index `i`,
+    `parent[i]`, `depth[i]`, `first_child[i]` and `next_sibling[i]` hold
+    the tree structure in parallel arrays, using -1 for "none".
+    Toplevel messages are siblings of each other.
+    """
+    def __init__(self):
+        self.messages = []
+        self.parent = array('l')
+        self.depth = array('l')
+        self.first_child = array('l')
+        self.next_sibling = array('l')
+        self._last_child = array('l')  # only needed while appending
+        self._last_root = -1
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, msg, parent=-1):
+        """adds a message to the tree. Messages must be appended in
+        depth-first order.
+
+        :param msg: the message to add
+        :type msg: alot.message.Message
+        :param parent: index of the parent message, -1 for toplevel
+        :type parent: int
+        :returns: the index of the added message
+        """
+        index = len(self.messages)
+        self.messages.append(msg)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self._last_child.append(-1)
+        if parent == -1:
+            self.depth.append(0)
+            previous = self._last_root
+            self._last_root = index
+        else:
+            self.depth.append(self.depth[parent] + 1)
+            previous = self._last_child[parent]
+            if previous == -1:
+                self.first_child[parent] = index
+            self._last_child[parent] = index
+        if previous != -1:
+            self.next_sibling[previous] = index
+        return index
+
+    def children(self, index):
+        """returns the indices of all direct replies to message `index`"""
+        result = []
+        child = self.first_child[index]
+        while child != -1:
+            result.append(child)
+            child = self.next_sibling[child]
+        return result
+
+
+class Thread(object):
+    """
+    a thread in the index. Like :class:`~alot.message.Message`, it has no
+    instance dict, keeps dates as timestamps and tags as interned strings.
+    Its messages are only looked up when asked for.
+    """
+    __slots__ = ('_dbman', '_id', '_total_messages', '_authors', '_subject',
+                 '_oldest_ts', '_newest_ts', '_tags', '_messages',
+                 '_toplevel_messages', '_replies', '_parents', '_tree')
 
-class Thread:
     def __init__(self, dbman, thread):
         """
         :param dbman: db manager that is used for further lookups
@@ -188,30 +917,43 @@ class Thread:
 
     def refresh(self, thread=None):
         if not thread:
-            query = self._dbman.query('thread:' + self._id)
-            thread = query.search_threads().next()
+            thread = self._dbman.backend.get_thread(self._id)
         self._total_messages = thread.get_total_messages()
         self._authors = thread.get_authors()
         self._subject = thread.get_subject()
-        ts = thread.get_oldest_date()
-        self._oldest_date = datetime.fromtimestamp(ts)
-        self._newest_date = datetime.fromtimestamp(thread.get_newest_date())
-        self._tags = set([t for t in thread.get_tags()])
-        self._messages = {}  # this maps messages to its children
-        self._toplevel_messages = []
+        self._oldest_ts = thread.get_oldest_date()
+        self._newest_ts = thread.get_newest_date()
+        self._tags = intern_tags(thread.get_tags())
+        # the following are built by get_messages
+        self._messages = None  # this maps messages to its children
+        self._toplevel_messages = None
+        self._replies = None  # maps message ids to lists of replies
+        self._parents = None  # maps message ids to parent messages
+        self._tree = None
 
     def __str__(self):
         return "thread:%s: %s" % (self._id, self.get_subject())
 
+    def copy(self):
+        """returns a thread with the summary of this one, but none of the
+        messages that were looked up for it"""
+        thread = Thread.__new__(Thread)
+        for name in Thread.__slots__:
+            setattr(thread, name, getattr(self, name))
+        thread._messages = None
+        thread._toplevel_messages = None
+        thread._replies = None
+        thread._parents = None
+        thread._tree = None
+        return thread
+
     def get_thread_id(self):
         """returns id of this thread"""
         return self._id
 
     def get_tags(self):
         """returns tags attached to this thread as list of strings"""
-        l = list(self._tags)
-        l.sort()
-        return l
+        return list(self._tags)
 
     def add_tags(self, tags):
         """adds tags to all messages in this thread
@@ -222,7 +964,7 @@ class Thread:
         newtags = set(tags).difference(self._tags)
         if newtags:
             self._dbman.tag('thread:' + self._id, newtags)
-            self._tags = self._tags.union(newtags)
+            self._tags = intern_tags(self._tags + tuple(newtags))
 
     def remove_tags(self, tags):
         """remove tags from all messages in this thread
@@ -233,7 +975,7 @@ class Thread:
         rmtags = set(tags).intersection(self._tags)
         if rmtags:
             self._dbman.untag('thread:' + self._id, tags)
-            self._tags = self._tags.difference(rmtags)
+            self._tags = tuple(t for t in self._tags if t not in rmtags)
 
     def set_tags(self, tags):
         """set tags of all messages in this thread. This removes all tags and
@@ -242,9 +984,9 @@ class Thread:
         :param tags: tags to add
         :type tags: list of str
         """
-        if tags != self._tags:
+        if set(tags) != set(self._tags):
             self._dbman.tag('thread:' + self._id, tags, remove_rest=True)
-            self._tags = set(tags)
+            self._tags = intern_tags(tags)
 
     def get_authors(self):  # TODO: make this return a list of strings
         """returns all authors in this thread"""
@@ -256,7 +998,7 @@ class Thread:
 
     def get_toplevel_messages(self):
         """returns all toplevel messages as list of :class:`Message`"""
-        if not self._messages:
+        if self._messages is None:
             self.get_messages()
         return self._toplevel_messages
 
@@ -266,44 +1008,108 @@ class Thread:
         :returns: dict mapping all contained :class:`Message`s to a list of
         their respective children.
         """
-        if not self._messages:
-            query = self._dbman.query('thread:' + self._id)
-            thread = query.search_threads().next()
-
-            def accumulate(acc, msg):
-                M = Message(self._dbman, msg, thread=self)
-                acc[M] = []
-                r = msg.get_replies()
-                if r is not None:
-                    for m in r:
-                        acc[M].append(accumulate(acc, m))
-                return M
-
+        if self._messages is None:
+            tree = self.get_thread_tree()
             self._messages = {}
-            for m in thread.get_toplevel_messages():
-                self._toplevel_messages.append(accumulate(self._messages, m))
+            self._toplevel_messages = []
+            self._replies = {}
+            self._parents = {}
+            for index, msg in enumerate(tree.messages):
+                replies = [tree.messages[c] for c in tree.children(index)]
+                self._messages[msg] = replies
+                # index children and parent by id for constant time lookups
+                self._replies[msg.get_message_id()] = replies
+                parent = tree.parent[index]
+                if parent == -1:
+                    self._parents[msg.get_message_id()] = None
+                    self._toplevel_messages.append(msg)
+                else:
+                    self._parents[msg.get_message_id()] = tree.messages[parent]
         return self._messages
 
+    def get_thread_tree(self):
+        """returns the reply structure of this thread as
+        :class:`ThreadTree`"""
+        if self._tree is None:
+            thread = self._dbman.backend.get_thread(self._id)
+            tree = ThreadTree()
+            # iterative depth-first traversal, the stack holds pairs of
+            # notmuch messages and the tree index of their parent
+            stack = [(m, -1) for m in thread.get_toplevel_messages()]
+            stack.reverse()
+            while stack:
+                msg, parent = stack.pop()
+                index = tree.append(Message(self._dbman, msg, thread=self),
+                                    parent)
+                replies = msg.get_replies()
+                if replies is not None:
+                    children = [(m, index) for m in replies]
+                    children.reverse()
+                    stack.extend(children)
+            self._tree = tree
+        return self._tree
+
+    def get_snippet(self, length):
+        """
+        returns the snippets of the first messages of this thread, in
+        thread order, until they are at least length characters long.
+        The messages are walked one by one in the index, without looking
+        up the whole thread.
+
+        :param length: number of characters wanted
+        :type length: int
+        :rtype: unicode
+        """
+        thread = self._dbman.backend.get_thread(self._id)
+        if thread is None:
+            return u''
+        index = get_snippet_index()
+        snippets = []
+        # depth-first traversal, the stack holds iterators over siblings
+        stack = [iter(thread.get_toplevel_messages())]
+        while stack and length > 0:
+            try:
+                msg = stack[-1].next()
+            except StopIteration:
+                stack.pop()
+                continue
+            snippet = index.get(msg.get_message_id(), msg.get_filename())
+            if snippet:
+                snippets.append(snippet)
+                length -= len(snippet)
+            replies = msg.get_replies()
+            if replies is not None:
+                stack.append(iter(replies))
+        return u' '.join(snippets)
+
     def get_replies_to(self, msg):
         """returns all replies to the given message
 
         :param msg: the parent message, must be contained in thread
         :type msg: alot.sb.Message
         """
-        mid = msg.get_message_id()
-        msg_hash = self.get_messages()
-        for m in msg_hash.keys():
-            if m.get_message_id() == mid:
-                return msg_hash[m]
-        return None
+        if self._messages is None:
+            self.get_messages()
+        return self._replies.get(msg.get_message_id())
+
+    def get_parent_of(self, msg):
+        """returns the message the given one replies to, or None for
+        toplevel messages
+
+        :param msg: the reply, must be contained in thread
+        :type msg: alot.message.Message
+        """
+        if self._messages is None:
+            self.get_messages()
+        return self._parents.get(msg.get_message_id())
 
     def get_newest_date(self):
         """returns date header of newest message in this thread as datetime"""
-        return self._newest_date
+        return datetime.fromtimestamp(self._newest_ts)
 
     def get_oldest_date(self):
         """returns date header of oldest message in this thread as datetime"""
-        return self._oldest_date
+        return datetime.fromtimestamp(self._oldest_ts)
 
     def get_total_messages(self):
         """returns number of contained messages"""
@@ -26,12 +26,23 @@ import subprocess
 import email
 import mimetypes
 import os
+import threading
+import signal
 from email.mime.audio import MIMEAudio
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+_tags = {}  # maps tag strings to their shared instance
+
+
+def intern_tags(tags):
+    """returns tags as sorted tuple without duplicates. Equal tags are
+    represented by the same string object, so that the tags of many
+    messages and threads share their memory."""
+    return tuple(sorted(set(_tags.setdefault(t, t) for t in tags)))
+
 def shorten(string, maxlen):
     if maxlen>1 and len(string) > maxlen:
         string = string[:maxlen-1] + u'\u2026'
@@ -134,17 +145,36 @@ def pretty_datetime(d):
     return string
 
 
-def cmd_output(command_line):
+def cmd_output(command_line, timeout=None):
+    """returns the output of command_line, or None if it fails or, given
+    a timeout in seconds, does not finish in time"""
     args = shlex.split(command_line)
     try:
-        output = subprocess.check_output(args)
-    except subprocess.CalledProcessError:
-        return None
+        # with a timeout, the command gets its own process group so that
+        # children holding on to stdout are killed along with it
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                preexec_fn=timeout and os.setsid or None)
     except OSError:
         return None
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill, [proc])
+        timer.start()
+    output = proc.communicate()[0]
+    if timer:
+        timer.cancel()
+    if proc.returncode:  # failed or killed
+        return None
     return output
 
 
+def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:  # exited meanwhile
+        pass
+
+
 def attach(path, mail, filename=None):
     ctype, encoding = mimetypes.guess_type(path)
     if ctype is None or encoding is not None:
@@ -78,7 +78,9 @@ def main():
     aman = AccountManager(settings.config)
 
     # get ourselves a database manager
-    dbman = DBManager(path=args.db_path, ro=args.read_only)
+    cachesize = settings.config.getint('general', 'query_cache_size')
+    dbman = DBManager(path=args.db_path, ro=args.read_only,
+                      query_cache_size=cachesize)
 
     # set up global urwid command maps
     command_map['j'] = 'cursor down'
@@ -0,0 +1,358 @@
+"""
+This file is part of alot.
+
+Alot is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Alot is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
+"""
+import os
+import mmap
+import errno
+import email
+import binascii
+from collections import OrderedDict
+from email.parser import HeaderParser
+
+PAYLOAD_CHUNK_SIZE = 64 * 1024
+UUENCODINGS = ('x-uuencode', 'uuencode', 'uue', 'x-uue')
+STRUCTURE_CACHE_SIZE = 512
+
+_structures = OrderedDict()  # maps (path, mtime, size) to MessageSources
+structure_stats = {'hits': 0, 'misses': 0}
+
+
+def get_source(path):
+    """
+    returns the :class:`MessageSource` for the message file at path. The
+    scanned MIME structures of the :data:`STRUCTURE_CACHE_SIZE` most recently
+    used files are kept, and a file is scanned again once its size or
+    modification time changes.
+
+    :param path: path to the message file
+    :type path: str
+    """
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    source = _structures.pop(key, None)
+    if source is None:
+        structure_stats['misses'] += 1
+        source = MessageSource(path)
+        if len(_structures) >= STRUCTURE_CACHE_SIZE:
+            _structures.popitem(last=False)
+    else:
+        structure_stats['hits'] += 1
+    _structures[key] = source
+    return source
+
+
+def get_structure_stats():
+    """returns a dict holding hits and misses of the structure cache and
+    the number of cached files"""
+    stats = dict(structure_stats)
+    stats['files'] = len(_structures)
+    return stats
+
+
+def decode_base64(chunks):
+    """decodes base64 data that is given in chunks of arbitrary size,
+    yielding the decoded chunks"""
+    rest = ''
+    for chunk in chunks:
+        data = rest + chunk.translate(None, ' \t\r\n')
+        cut = len(data) - len(data) % 4
+        rest = data[cut:]
+        if cut:
+            try:
+                yield binascii.a2b_base64(data[:cut])
+            except binascii.Error:
+                pass  # like the email package, drop garbage
+    if rest.strip('='):
+        try:
+            yield binascii.a2b_base64(rest + '=' * (-len(rest) % 4))
+        except binascii.Error:
+            pass
+
+
+def decode_quopri(chunks):
+    """decodes quoted-printable data that is given in chunks of arbitrary
+    size, yielding the decoded chunks. Lines are decoded as a whole, so
+    that escapes and soft line breaks are never split."""
+    rest = ''
+    for chunk in chunks:
+        data = rest + chunk
+        cut = data.rfind('\n') + 1
+        rest = data[cut:]
+        if cut:
+            yield binascii.a2b_qp(data[:cut])
+    if rest:
+        yield binascii.a2b_qp(rest)
+
+
+class MimePart:
+    """
+    a MIME part of a :class:`MessageSource`. It knows the byte range of its
+    headers and body in the message file, but only the headers are parsed.
+    Offers the content-type accessors of :class:`email.message.Message`,
+    which answer from metadata recorded while scanning.
+    """
+    def __init__(self, source, start, body, end, headers):
+        """
+        :param source: the message file this part is read from
+        :type source: :class:`MessageSource`
+        :param start: offset of the first header line
+        :type start: int
+        :param body: offset of the first body byte
+        :type body: int
+        :param end: offset after the last body byte
+        :type end: int
+        :param headers: the parsed headers of this part
+        :type headers: email.message.Message
+        """
+        self.source = source
+        self.start = start
+        self.body = body
+        self.end = end
+        self.headers = headers
+        self.children = []
+        self.content_type = headers.get_content_type()
+        self.filename = headers.get_filename()
+        cte = headers.get('Content-Transfer-Encoding', '')
+        self.encoding = str(cte).strip().lower()
+
+    def __getitem__(self, name):
+        return self.headers[name]
+
+    def is_multipart(self):
+        return bool(self.children)
+
+    def get_content_type(self):
+        return self.content_type
+
+    def get_content_maintype(self):
+        return self.content_type.split('/')[0]
+
+    def get_content_charset(self):
+        return self.headers.get_content_charset()
+
+    def get_filename(self):
+        return self.filename
+
+    def get_payload_size(self):
+        """returns the size of the encoded body in bytes"""
+        return self.end - self.body
+
+    def get_decoded_size(self):
+        """returns an estimate of the size of the decoded body in bytes,
+        computed from the encoded size without reading the body"""
+        size = self.get_payload_size()
+        if self.encoding == 'base64':
+            # 57 bytes per line of 76 characters and a line break
+            return size * 57 / 77
+        elif self.encoding in UUENCODINGS:
+            return size * 45 / 62
+        return size
+
+    def iter_payload(self, chunksize=PAYLOAD_CHUNK_SIZE):
+        """yields the encoded body in chunks of at most chunksize bytes"""
+        return self.source.iter_range(self.body, self.end, chunksize)
+
+    def iter_decoded_payload(self, chunksize=PAYLOAD_CHUNK_SIZE):
+        """yields the body with its content transfer encoding undone, in
+        chunks of roughly chunksize bytes. base64 and quoted-printable are
+        decoded as they are read, so the body is never in memory as a
+        whole."""
+        cte = self.encoding
+        chunks = self.iter_payload(chunksize)
+        if cte == 'base64':
+            return decode_base64(chunks)
+        elif cte == 'quoted-printable':
+            return decode_quopri(chunks)
+        elif cte in UUENCODINGS:
+            return iter([self.get_payload(decode=True)])
+        return chunks
+
+    def get_payload(self, decode=False):
+        """returns the body of this part as string. Only this part is read,
+        not the whole message.
+
+        :param decode: undo the content transfer encoding
+        :type decode: boolean
+        """
+        part = email.message_from_string(self.source.read(self.start,
+                                                          self.end))
+        return part.get_payload(decode=decode)
+
+    def walk(self):
+        """yields this part and all its subparts, depth first"""
+        stack = [self]
+        while stack:
+            part = stack.pop()
+            yield part
+            stack.extend(reversed(part.children))
+
+
+class MessageSource:
+    """
+    a message file that is read through a memory map. The MIME structure is
+    scanned once, recording the byte offsets of every part. Afterwards
+    headers, parts and payload ranges are sliced from the mapping and the
+    whole file is never copied into memory.
+
+    The mapping is only held while reading, so that sources for many
+    messages do not keep as many files open. As the file may have been
+    renamed in the meantime, e.g. when notmuch synchronizes tags to maildir
+    flags, :attr:`locate` is asked for its current path if it is gone.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to the message file
+        :type path: str
+        """
+        self.path = path
+        self.locate = None  # returns the current path of the file or None
+        self.size = os.path.getsize(path)
+        self.root = None
+        self._map = None
+        self._users = 0
+        self._open()
+        try:
+            self.root = self._scan(0, self.size)
+        finally:
+            self._close()
+
+    def _open(self):
+        if self._users == 0 and self.size:
+            try:
+                f = open(self.path)
+            except IOError, e:
+                path = None
+                if e.errno == errno.ENOENT and self.locate:
+                    path = self.locate()
+                if path is None:
+                    raise
+                self.path = path
+                f = open(path)
+            try:
+                self._map = mmap.mmap(f.fileno(), self.size,
+                                      access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        self._users += 1
+
+    def _close(self):
+        self._users -= 1
+        if self._users == 0 and self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def read(self, start, end):
+        """returns the bytes from start to end as string"""
+        self._open()
+        try:
+            if self._map is None:
+                return ''
+            return self._map[start:end]
+        finally:
+            self._close()
+
+    def iter_range(self, start, end, chunksize=PAYLOAD_CHUNK_SIZE):
+        """yields the bytes from start to end in chunks of at most
+        chunksize bytes"""
+        self._open()
+        try:
+            for pos in xrange(start, end, chunksize):
+                yield self._map[pos:min(pos + chunksize, end)]
+        finally:
+            self._close()
+
+    def get_headers(self):
+        """returns the parsed headers of the message"""
+        return self.root.headers
+
+    def walk(self):
+        """yields all MIME parts of the message as :class:`MimePart`, in the
+        order of :meth:`email.message.Message.walk`"""
+        return self.root.walk()
+
+    def _find_body(self, start, end):
+        """returns the offsets of the empty line that ends the header block
+        starting at start, and of the first body byte"""
+        m = self._map
+        if m[start:start + 1] == '\n':
+            return start, start + 1
+        if m[start:start + 2] == '\r\n':
+            return start, start + 2
+        candidates = []
+        pos = m.find('\n\n', start, end)
+        if pos != -1:
+            candidates.append((pos + 1, pos + 2))
+        pos = m.find('\n\r\n', start, end)
+        if pos != -1:
+            candidates.append((pos + 1, pos + 3))
+        if not candidates:
+            return end, end
+        return min(candidates)
+
+    def _scan(self, start, end):
+        if self._map is None:  # empty file
+            return MimePart(self, 0, 0, 0, HeaderParser().parsestr(''))
+        headerend, body = self._find_body(start, end)
+        headers = HeaderParser().parsestr(self._map[start:headerend])
+        part = MimePart(self, start, body, end, headers)
+        if headers.get_content_maintype() == 'multipart':
+            boundary = headers.get_boundary()
+            if boundary:
+                for substart, subend in self._split(body, end, boundary):
+                    part.children.append(self._scan(substart, subend))
+        elif headers.get_content_type() == 'message/rfc822':
+            part.children.append(self._scan(body, end))
+        return part
+
+    def _split(self, start, end, boundary):
+        """returns the byte ranges of the parts of a multipart body"""
+        m = self._map
+        delimiter = '--' + boundary
+        ranges = []
+        partstart = None
+        if m[start:start + len(delimiter)] == delimiter:
+            linestart = start  # delimiter on the first line
+        else:
+            linestart = self._find_delimiter(delimiter, start, end)
+        while linestart != -1:
+            after = linestart + len(delimiter)
+            if m[after:after + 1] not in ('-', ' ', '\t', '\r', '\n', ''):
+                # a longer boundary that starts with this one
+                linestart = self._find_delimiter(delimiter, after, end)
+                continue
+            if partstart is not None:
+                # the line break before a delimiter belongs to it
+                partend = linestart - 1
+                if partend > partstart and m[partend - 1] == '\r':
+                    partend -= 1
+                ranges.append((partstart, max(partstart, partend)))
+            if m[after:after + 2] == '--':  # closing delimiter
+                break
+            lineend = m.find('\n', after, end)
+            if lineend == -1:
+                break
+            partstart = lineend + 1
+            linestart = self._find_delimiter(delimiter, lineend, end)
+        return ranges
+
+    def _find_delimiter(self, delimiter, start, end):
+        """returns the offset of the next line that starts with delimiter"""
+        pos = self._map.find('\n' + delimiter, start, end)
+        if pos == -1:
+            return -1
+        return pos + 1
@@ -0,0 +1,430 @@
+"""
+This file is part of alot.
+
+Alot is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Notmuch is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
+"""
+import os
+import re
+import threading
+import random
+import email
+import email.utils
+from email.mime.text import MIMEText
+
+from db import Backend
+from db import DatabaseLockedError
+from db import DatabaseQueryError
+
+TOKEN_PATTERN = re.compile(r'\(|\)|"[^"]*"|[^\s()]+')
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+# header fields whose words are indexed, and the prefixes to search them
+TEXT_FIELDS = {'from': 'From', 'to': 'To', 'subject': 'Subject'}
+# prefixes that match a single term exactly
+EXACT_PREFIXES = {'id': 'id', 'thread': 'thread', 'tag': 'tag', 'is': 'tag'}
+
+
+def words(text):
+    """returns the lower case words in text"""
+    return [w.lower() for w in WORD_PATTERN.findall(text or '')]
+
+
+class MemoryMessage:
+    """a message in a :class:`MemoryBackend`, offers the accessors of
+    :class:`notmuch.Message`"""
+    def __init__(self, mid, tid, date, headers, tags, filename=None):
+        self.mid = mid
+        self.tid = tid
+        self.date = date
+        self.headers = headers
+        self.tags = set(tags)
+        self.filename = filename
+        self.replies = []
+
+    def get_message_id(self):
+        return self.mid
+
+    def get_thread_id(self):
+        return self.tid
+
+    def get_date(self):
+        return self.date
+
+    def get_filename(self):
+        return self.filename
+
+    def get_header(self, name):
+        return self.headers.get(name, '')
+
+    def get_tags(self):
+        return list(self.tags)
+
+    def get_replies(self):
+        return iter(self.replies)
+
+
+class MemoryThread:
+    """snapshot of a thread in a :class:`MemoryBackend`, offers the
+    accessors of :class:`notmuch.Thread`"""
+    def __init__(self, tid, messages):
+        """
+        :param tid: thread id
+        :type tid: str
+        :param messages: all messages of the thread, oldest first
+        :type messages: list of :class:`MemoryMessage`
+        """
+        self.tid = tid
+        self.messages = messages
+
+    def get_thread_id(self):
+        return self.tid
+
+    def get_total_messages(self):
+        return len(self.messages)
+
+    def get_authors(self):
+        authors = []
+        for msg in self.messages:
+            name, address = email.utils.parseaddr(msg.get_header('From'))
+            author = name or address
+            if author not in authors:
+                authors.append(author)
+        return ', '.join(authors)
+
+    def get_subject(self):
+        return self.messages[0].get_header('Subject')
+
+    def get_oldest_date(self):
+        return self.messages[0].date
+
+    def get_newest_date(self):
+        return self.messages[-1].date
+
+    def get_tags(self):
+        tags = set()
+        for msg in self.messages:
+            tags.update(msg.tags)
+        return list(tags)
+
+    def get_toplevel_messages(self):
+        mids = set(msg.mid for msg in self.messages)
+        return [msg for msg in self.messages
+                if msg.get_header('In-Reply-To') not in mids]
+
+
+class MemoryBackend(Backend):
+    """
+    a pure python index that lives in memory. It supports the subset of the
+    notmuch query language that alot uses itself: `*`, the prefixes
+    `id:`, `thread:`, `tag:`, `is:`, `from:`, `to:` and `subject:`, bare
+    words (matched against from, to and subject), quoted phrases,
+    `AND`, `OR`, `NOT` and parentheses.
+
+    The flush worker writes from its own thread while the ui searches, so
+    all lookups and writes hold :attr:`lock`. The tag sets of messages are
+    replaced rather than changed, as threads handed out keep reading them.
+    """
+    def __init__(self):
+        self.messages = {}  # maps message ids to MemoryMessages
+        self.threads = {}  # maps thread ids to lists of message ids
+        self.postings = {}  # maps (prefix, term) pairs to message ids
+        self.locked = False  # set this to simulate a locked index
+        self.lock = threading.RLock()
+        self._thread_counter = 0
+
+    def add_message(self, mid, headers, date, tags=[], filename=None):
+        """
+        adds a message to the index. It is appended to the thread of the
+        message its `In-Reply-To` header names, so replies have to be added
+        after their parents.
+
+        :param mid: message id
+        :type mid: str
+        :param headers: maps header names to their (decoded) values
+        :type headers: dict of str -> str
+        :param date: seconds since the epoch
+        :type date: int
+        :param tags: initial tags
+        :type tags: list of str
+        :param filename: path to the message file, needed to display
+                         message bodies
+        :type filename: str
+        :rtype: :class:`MemoryMessage`
+        """
+        with self.lock:
+            parent = self.messages.get(headers.get('In-Reply-To'))
+            if parent is not None:
+                tid = parent.tid
+            else:
+                tid = '%016x' % self._thread_counter
+                self._thread_counter += 1
+                self.threads[tid] = []
+            msg = MemoryMessage(mid, tid, date, headers, tags, filename)
+            if parent is not None:
+                parent.replies.append(msg)
+            self.messages[mid] = msg
+            self.threads[tid].append(mid)
+            self.threads[tid].sort(key=lambda m: self.messages[m].date)
+            self._post(('id', mid), mid)
+            self._post(('thread', tid), mid)
+            for tag in msg.tags:
+                self._post(('tag', tag), mid)
+            for prefix, header in TEXT_FIELDS.items():
+                for word in words(headers.get(header)):
+                    self._post((prefix, word), mid)
+            return msg
+
+    def add_file(self, path, tags=[]):
+        """adds the message stored in the file at path
+
+        :param path: path to a rfc822 message
+        :type path: str
+        :param tags: initial tags
+        :type tags: list of str
+        """
+        mail = email.message_from_file(open(path))
+        headers = dict(mail.items())
+        mid = headers.get('Message-ID', path).strip('<>')
+        if 'In-Reply-To' in headers:
+            headers['In-Reply-To'] = headers['In-Reply-To'].strip('<>')
+        date = email.utils.parsedate_tz(headers.get('Date', ''))
+        date = date and email.utils.mktime_tz(date) or 0
+        return self.add_message(mid, headers, date, tags, filename=path)
+
+    # the helpers below, down to _match, expect the lock to be held
+
+    def _post(self, key, mid):
+        if key not in self.postings:
+            self.postings[key] = set()
+        self.postings[key].add(mid)
+
+    def _unpost(self, key, mid):
+        postings = self.postings.get(key)
+        if postings is not None:
+            postings.discard(mid)
+            if not postings:
+                del self.postings[key]
+
+    def _thread(self, tid):
+        msgs = [self.messages[mid] for mid in self.threads[tid]]
+        return MemoryThread(tid, msgs)
+
+    def search_messages(self, querystring):
+        """returns the set of ids of all messages that match querystring"""
+        tokens = TOKEN_PATTERN.findall(querystring)
+        if not tokens:
+            raise DatabaseQueryError(querystring)
+        with self.lock:
+            result, pos = self._parse_or(tokens, 0)
+        if pos != len(tokens):
+            raise DatabaseQueryError(querystring)
+        return result
+
+    def _parse_or(self, tokens, pos):
+        result, pos = self._parse_and(tokens, pos)
+        while pos < len(tokens) and tokens[pos] == 'OR':
+            other, pos = self._parse_and(tokens, pos + 1)
+            result = result | other
+        return result, pos
+
+    def _parse_and(self, tokens, pos):
+        result, pos = self._parse_not(tokens, pos)
+        while pos < len(tokens) and tokens[pos] not in ('OR', ')'):
+            if tokens[pos] == 'AND':
+                pos += 1
+            other, pos = self._parse_not(tokens, pos)
+            result = result & other
+        return result, pos
+
+    def _parse_not(self, tokens, pos):
+        if pos < len(tokens) and tokens[pos] == 'NOT':
+            result, pos = self._parse_not(tokens, pos + 1)
+            return set(self.messages) - result, pos
+        return self._parse_atom(tokens, pos)
+
+    def _parse_atom(self, tokens, pos):
+        if pos >= len(tokens) or tokens[pos] in ('AND', 'OR', ')'):
+            raise DatabaseQueryError(' '.join(tokens))
+        token = tokens[pos]
+        if token == '(':
+            result, pos = self._parse_or(tokens, pos + 1)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise DatabaseQueryError(' '.join(tokens))
+            return result, pos + 1
+        if token == '*':
+            return set(self.messages), pos + 1
+        return self._match(token), pos + 1
+
+    def _match(self, token):
+        prefix, sep, value = token.partition(':')
+        if not sep:
+            prefix, value = None, token
+        value = value.strip('"')
+        if prefix in EXACT_PREFIXES:
+            return set(self.postings.get((EXACT_PREFIXES[prefix], value), ()))
+        if prefix is None:
+            fields = TEXT_FIELDS.keys()
+        elif prefix in TEXT_FIELDS:
+            fields = [prefix]
+        else:
+            raise DatabaseQueryError(token)
+        result = None
+        for word in words(value):  # all words of a phrase have to match
+            matches = set()
+            for field in fields:
+                matches.update(self.postings.get((field, word), ()))
+            if result is None:
+                result = matches
+            else:
+                result &= matches
+        return result or set()
+
+    def search_threads(self, querystring):
+        with self.lock:
+            tids = set(self.messages[mid].tid
+                       for mid in self.search_messages(querystring))
+            threads = [self._thread(tid) for tid in tids]
+        threads.sort(key=lambda t: t.get_newest_date(), reverse=True)
+        return iter(threads)
+
+    def count_messages(self, querystring):
+        return len(self.search_messages(querystring))
+
+    def search_message_ids(self, querystring):
+        return set(self.search_messages(querystring))
+
+    def get_thread(self, tid):
+        with self.lock:
+            if tid not in self.threads:
+                return None
+            return self._thread(tid)
+
+    def find_message(self, mid):
+        with self.lock:
+            return self.messages.get(mid)
+
+    def get_all_tags(self):
+        with self.lock:
+            tags = [term for prefix, term in self.postings
+                    if prefix == 'tag']
+        tags.sort()
+        return tags
+
+    def open_writer(self):
+        if self.locked:
+            raise DatabaseLockedError()
+        return MemoryWriter(self)
+
+
+class MemoryWriter:
+    """writes tags to a :class:`MemoryBackend`"""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def message_ids(self, querystring):
+        return list(self.backend.search_messages(querystring))
+
+    def write(self, deltas, progress=None):
+        backend = self.backend
+        with backend.lock:
+            for mid, delta in deltas.items():
+                msg = backend.messages.get(mid)
+                if msg is None:
+                    continue
+                add, remove = delta.resolve(msg.get_tags())
+                for tag in remove:
+                    backend._unpost(('tag', tag), mid)
+                for tag in add:
+                    backend._post(('tag', tag), mid)
+                msg.tags = (msg.tags - set(remove)) | set(add)
+        if progress:
+            progress(len(deltas), len(deltas))
+
+    def close(self):
+        pass
+
+
+NAMES = ['Alice Smith', 'Bob Jones', 'Carol White', 'Dave Brown',
+         'Eve Black', 'Frank Green', 'Grace Hall', 'Heidi Young']
+WORDS = ['release', 'patch', 'meeting', 'notes', 'build', 'broken', 'review',
+         'draft', 'plan', 'question', 'update', 'bug', 'fix', 'docs', 'test']
+TAGS = ['inbox', 'unread', 'flagged', 'replied', 'attachment']
+
+
+def generate_corpus(backend, messages=1000, seed=0, reply_rate=0.6,
+                    maildir=None):
+    """
+    fills backend with a reproducible synthetic corpus: the same
+    arguments always produce the same messages, threads and tags.
+
+    :param backend: index to add the messages to
+    :type backend: :class:`MemoryBackend`
+    :param messages: number of messages to generate
+    :type messages: int
+    :param seed: seed of the random generator
+    :type seed: int
+    :param reply_rate: probability that a message replies to an earlier one
+    :type reply_rate: float
+    :param maildir: if set, message files are written to its `cur`
+                    subdirectory so that bodies can be displayed
+    :type maildir: str
+    """
+    rnd = random.Random(seed)
+    # bodies come from their own generator, so that writing files does not
+    # change the corpus
+    bodyrnd = random.Random(seed)
+    date = 1300000000
+    mids = []
+    if maildir:
+        curdir = os.path.join(maildir, 'cur')
+        if not os.path.isdir(curdir):
+            os.makedirs(curdir)
+    for num in xrange(messages):
+        date += rnd.randint(1, 3600)
+        sender = rnd.choice(NAMES)
+        headers = {
+            'Message-ID': '%d.%d@corpus.example' % (seed, num),
+            'From': '%s <%s@example.com>' % (sender,
+                                             sender.split()[0].lower()),
+            'To': 'list@example.com',
+            'Date': email.utils.formatdate(date),
+        }
+        if mids and rnd.random() < reply_rate:
+            # most replies go to recent messages
+            parent = backend.messages[rnd.choice(mids[-50:])]
+            headers['In-Reply-To'] = parent.mid
+            subject = parent.get_header('Subject')
+            if not subject.startswith('Re: '):
+                subject = 'Re: ' + subject
+        else:
+            subject = ' '.join(rnd.sample(WORDS, rnd.randint(2, 5)))
+        headers['Subject'] = subject
+        tags = [t for t in TAGS if rnd.random() < 0.3]
+        filename = None
+        if maildir:
+            body = ' '.join(bodyrnd.choice(WORDS)
+                            for i in xrange(bodyrnd.randint(10, 400)))
+            mail = MIMEText(body)
+            for key, value in headers.items():
+                if key in ('Message-ID', 'In-Reply-To'):
+                    value = '<%s>' % value
+                mail[key] = value
+            filename = os.path.join(curdir, '%d.%d:2,' % (seed, num))
+            f = open(filename, 'w')
+            f.write(mail.as_string())
+            f.close()
+        mid = headers['Message-ID']
+        backend.add_message(mid, headers, date, tags, filename)
+        mids.append(mid)
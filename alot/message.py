@@ -17,19 +17,167 @@ along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
 Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
 """
 import os
+import errno
 import email
 import tempfile
 import re
 import mimetypes
 from datetime import datetime
+from collections import OrderedDict
 from email.header import Header
+from email.parser import HeaderParser
 
 import helper
+import render
+import snippet
+from mailsource import get_source
+from mailsource import MimePart
 from settings import get_mime_handler
 from settings import config
 
+# number of bytes read from message files, by parse stage
+parse_stats = {'headers': 0, 'full': 0}
+
+
+def get_parse_stats():
+    """returns a dict that holds how many bytes of message files were
+    parsed for headers only and in full"""
+    return dict(parse_stats)
+
+
+def read_headers(path):
+    """
+    parses only the header block of the message file at path.
+    Reading stops at the first empty line, so the size of the body does not
+    matter.
+
+    :param path: path to the message file
+    :type path: str
+    :rtype: email.message.Message without payload
+    """
+    lines = []
+    f_mail = open(path)
+    for line in f_mail:
+        lines.append(line)
+        if not line.strip('\r\n'):
+            break
+    f_mail.close()
+    headertext = ''.join(lines)
+    parse_stats['headers'] += len(headertext)
+    return HeaderParser().parsestr(headertext)
+
+
+def read_file(path):
+    """returns the content of the file at path"""
+    f = open(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class FileLocator:
+    """
+    looks up the current path of a message file in the index. notmuch
+    renames the file when it synchronizes tags to maildir flags.
+
+    It holds only the backend and the message id, so that a cached
+    :class:`~alot.mailsource.MessageSource` that uses it as its
+    :attr:`~alot.mailsource.MessageSource.locate` callback does not keep
+    the :class:`Message` and its thread alive.
+    """
+    def __init__(self, backend, mid):
+        """
+        :param backend: index to look the message up in
+        :type backend: :class:`~alot.db.Backend`
+        :param mid: message id
+        :type mid: str
+        """
+        self.backend = backend
+        self.mid = mid
+
+    def __call__(self):
+        """returns the path, or None if the message is gone"""
+        msg = self.backend.find_message(self.mid)
+        if msg is None:
+            return None
+        return msg.get_filename()
+
+
+class EmailCache:
+    """
+    least recently used cache of parsed emails, shared by all
+    :class:`Message` objects. It is bounded by the size of the message
+    files the entries were parsed from, which is what the parsed payloads
+    hold on to.
+    """
+    def __init__(self, budget):
+        """
+        :param budget: maximal size of all entries in bytes
+        :type budget: int
+        """
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # maps keys to (email, size) pairs
+
+    def get(self, key):
+        """returns the email for key and marks it as recently used"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, mail, size):
+        """adds an entry, evicting others if the budget is exceeded.
+        Entries larger than the whole budget are not kept."""
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        if size > self.budget:
+            return
+        self._entries[key] = (mail, size)
+        self.size += size
+        while self.size > self.budget and self._entries:
+            oldest, (mail, size) = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def get_stats(self):
+        """returns a dict with hit, miss and eviction counters as well as
+        the number of resident emails and their size in bytes"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._entries),
+                'size': self.size, 'budget': self.budget}
+
+
+_email_cache = None
+
+
+def get_email_cache():
+    """returns the process wide :class:`EmailCache`, with the budget set by
+    the parsed_email_cache_size option"""
+    global _email_cache
+    if _email_cache is None:
+        budget = config.getint('general', 'parsed_email_cache_size')
+        _email_cache = EmailCache(budget * 1024 * 1024)
+    return _email_cache
+
+
+class Message(object):
+    """
+    a message in the index. Dates are kept as timestamps and tags as
+    interned strings, and there is no instance dict, since a thread view
+    holds many of these.
+    """
+    __slots__ = ('_dbman', '_id', '_thread_id', '_thread', '_timestamp',
+                 '_filename', '_from', '_headers', '_source', '_attachments',
+                 '_tags')
 
-class Message:
     def __init__(self, dbman, msg, thread=None):
         """
         :param dbman: db manager that is used for further lookups
@@ -43,12 +191,13 @@ class Message:
         self._id = msg.get_message_id()
         self._thread_id = msg.get_thread_id()
         self._thread = thread
-        self._datetime = datetime.fromtimestamp(msg.get_date())
+        self._timestamp = msg.get_date()
         self._filename = msg.get_filename()
         self._from = msg.get_header('From')
-        self._email = None  # will be read upon first use
+        self._headers = None  # will be read upon first use
+        self._source = None  # will be read upon first use
         self._attachments = None  # will be read upon first use
-        self._tags = set(msg.get_tags())
+        self._tags = helper.intern_tags(msg.get_tags())
 
     def __str__(self):
         """prettyprint the message"""
@@ -67,21 +216,56 @@ class Message:
         return res
 
     def get_email(self):
-        """returns email.Message representing this message"""
-        if not self._email:
-            f_mail = open(self.get_filename())
-            self._email = email.message_from_file(f_mail)
-            f_mail.close()
-        return self._email
+        """returns email.Message representing this message. Parsed emails
+        are kept in the :class:`EmailCache` and parsed again once they were
+        evicted from it."""
+        cache = get_email_cache()
+        mail = cache.get(self._filename)
+        if mail is None:
+            data = self._read_file(read_file)
+            parse_stats['full'] += len(data)
+            mail = email.message_from_string(data)
+            cache.put(self._filename, mail, len(data))
+        return mail
+
+    def get_headers(self):
+        """returns an email.Message that holds only the headers of this
+        message. Unlike :meth:`get_email`, this does not read the body."""
+        if not self._headers:
+            self._headers = self._read_file(read_headers)
+        return self._headers
 
     def get_date(self):
         """returns date as datetime obj"""
-        return self._datetime
+        return datetime.fromtimestamp(self._timestamp)
 
     def get_filename(self):
         """returns absolute path of messages location"""
         return self._filename
 
+    def locate_file(self):
+        """looks up the current path of the message file in the index
+        and remembers it. Returns the path, or None if the message is
+        gone."""
+        path = FileLocator(self._dbman.backend, self._id)()
+        if path is not None:
+            self._filename = path
+        return path
+
+    def _read_file(self, reader):
+        """returns what reader returns for the path of the message file.
+        If the file is gone, reader is called again with its current path
+        as recorded in the index."""
+        try:
+            return reader(self._filename)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            oldname = self._filename
+            if self.locate_file() in (None, oldname):
+                raise
+        return reader(self._filename)
+
     def get_message_id(self):
         """returns messages id (a string)"""
         return self._id
@@ -90,19 +274,26 @@ class Message:
         """returns id of messages thread (a string)"""
         return self._thread_id
 
+    def get_source(self):
+        """returns the memory mapped message file as
+        :class:`~alot.mailsource.MessageSource`"""
+        if not self._source:
+            self._source = self._read_file(get_source)
+            self._source.locate = FileLocator(self._dbman.backend, self._id)
+        return self._source
+
     def get_message_parts(self):
-        """returns a list of all body parts of this message"""
+        """returns a list of all body parts of this message as
+        :class:`~alot.mailsource.MimePart`. Their bodies are not read."""
         out = []
-        for msg in self.get_email().walk():
-            if not msg.is_multipart():
-                out.append(msg)
+        for part in self.get_source().walk():
+            if not part.is_multipart():
+                out.append(part)
         return out
 
     def get_tags(self):
         """returns tags attached to this message as list of strings"""
-        l = list(self._tags)
-        l.sort()
-        return l
+        return list(self._tags)
 
     def get_thread(self):
         """returns the thread this msg belongs to as alot.db.Thread object"""
@@ -119,9 +310,9 @@ class Message:
         """returns formated datestring"""
         formatstring = config.get('general', 'timestamp_format')
         if formatstring:
-            res = self._datetime.strftime(formatstring)
+            res = self.get_date().strftime(formatstring)
         else:
-            res = helper.pretty_datetime(self._datetime)
+            res = helper.pretty_datetime(self.get_date())
         return res
 
     def get_author(self):
@@ -135,7 +326,7 @@ class Message:
         :type tags: list of str
         """
         self._dbman.tag('id:' + self._id, tags)
-        self._tags = self._tags.union(tags)
+        self._tags = helper.intern_tags(self._tags + tuple(tags))
 
     def remove_tags(self, tags):
         """remove tags from message
@@ -144,7 +335,7 @@ class Message:
         :type tags: list of str
         """
         self._dbman.untag('id:' + self._id, tags)
-        self._tags = self._tags.difference(tags)
+        self._tags = tuple(t for t in self._tags if t not in tags)
 
     def get_attachments(self):
         if not self._attachments:
@@ -155,12 +346,18 @@ class Message:
         return self._attachments
 
     def accumulate_body(self):
-        return extract_body(self.get_email())
+        return extract_body(self.get_source())
 
     def matches(self, querystring):
         searchfor = querystring + ' AND id:' + self._id
         return self._dbman.count_messages(searchfor) > 0
 
+    def get_snippet(self):
+        """returns the leading text of this message as unicode. Snippets
+        are kept in the :class:`~alot.snippet.SnippetIndex`, so this
+        usually does not read the message file."""
+        return snippet.get_snippet_index().get(self._id, self._filename)
+
     def get_text_content(self):
         res = ''
         for part in self.get_email().walk():
@@ -177,44 +374,49 @@ class Message:
 
 
 def extract_body(mail):
+    """returns the printable parts of mail as one unicode string, parts
+    that need a mailcap handler are rendered right away"""
     bodytxt = ''
+    for piece in body_pieces(mail):
+        if isinstance(piece, render.RenderJob):
+            piece = piece.finish(render.render_external(piece.handler,
+                                                        piece.payload))
+        bodytxt += piece
+    return bodytxt
+
+
+def body_pieces(mail):
+    """
+    yields the printable parts of mail in order. Parts that have to be
+    rendered by a mailcap handler come as :class:`~alot.render.RenderJob`,
+    all others as unicode strings. Only the parts that are displayed are
+    read and decoded, so attachments without a handler cost nothing.
+
+    :param mail: the email to display
+    :type mail: :class:`~alot.mailsource.MessageSource` or
+                email.message.Message
+    """
+    builtin_html = config.get('general', 'html_renderer') == 'builtin'
     for part in mail.walk():
+        if part.is_multipart():
+            continue
         ctype = part.get_content_type()
-        enc = part.get_content_charset()
-        raw_payload = part.get_payload(decode=True)
-        if part.get_content_maintype() == 'text':
-            if enc:
-                raw_payload = unicode(raw_payload, enc)
-            else:
-                raw_payload = unicode(raw_payload, errors='replace')
         if ctype == 'text/plain':
-            bodytxt += raw_payload
+            yield decode_to_unicode(part)
+        elif ctype == 'text/html' and builtin_html:
+            yield render.render_html(decode_to_unicode(part))
         else:
             #get mime handler
             handler = get_mime_handler(ctype, key='view',
                                        interactive=False)
             if handler:
-                #open tempfile. Not all handlers accept stuff from stdin
-                tmpfile = tempfile.NamedTemporaryFile(delete=False,
-                                                      suffix='.html')
-                #write payload to tmpfile
                 if part.get_content_maintype() == 'text':
-                    tmpfile.write(raw_payload.encode('utf8'))
+                    fallback = decode_to_unicode(part)
+                    data = fallback.encode('utf8')
                 else:
-                    tmpfile.write(raw_payload)
-                #create and call external command
-                cmd = handler % tmpfile.name
-                rendered_payload = helper.cmd_output(cmd)
-                #remove tempfile
-                tmpfile.close()
-                os.unlink(tmpfile.name)
-                if rendered_payload:  # handler had output
-                    bodytxt += unicode(rendered_payload.strip(),
-                                       encoding='utf8', errors='replace')
-                elif part.get_content_maintype() == 'text':
-                    bodytxt += raw_payload
-                # else drop
-    return bodytxt
+                    data = part.get_payload(decode=True)
+                    fallback = u''  # drop
+                yield render.RenderJob(handler, data, ctype, fallback)
 
 
 def decode_to_unicode(part):
@@ -285,7 +487,8 @@ class Attachment:
     def __init__(self, emailpart):
         """
         :param emailpart: a non-multipart email that is the attachment
-        :type emailpart: email.message.Message
+        :type emailpart: email.message.Message or
+                         :class:`~alot.mailsource.MimePart`
         """
         self.part = emailpart
 
@@ -307,7 +510,11 @@ class Attachment:
 
     def get_size(self):
         """returns attachments size as human-readable string"""
-        size_in_kbyte = len(self.part.get_payload()) / 1024
+        if isinstance(self.part, MimePart):
+            size = self.part.get_decoded_size()
+        else:
+            size = len(self.part.get_payload())
+        size_in_kbyte = size / 1024
         if size_in_kbyte > 1024:
             return "%.1fM" % (size_in_kbyte / 1024.0)
         else:
@@ -321,6 +528,20 @@ class Attachment:
             FILE = open(path, "w")
         else:
             FILE = tempfile.NamedTemporaryFile(delete=False)
-        FILE.write(self.part.get_payload(decode=True))
+        self.write(FILE)
         FILE.close()
         return FILE.name
+
+    def write(self, fileobj):
+        """writes the decoded attachment to fileobj. Parts of a message
+        file are decoded while they are read, so that large attachments
+        are never completely held in memory.
+
+        :param fileobj: file to write to
+        :type fileobj: file
+        """
+        if isinstance(self.part, MimePart):
+            for chunk in self.part.iter_decoded_payload():
+                fileobj.write(chunk)
+        else:
+            fileobj.write(self.part.get_payload(decode=True))
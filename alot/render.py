@@ -0,0 +1,500 @@
+"""
+This file is part of alot.
+
+Alot is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Alot is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
+"""
+import os
+import Queue
+import hashlib
+import tempfile
+import threading
+import logging
+import HTMLParser
+from htmlentitydefs import name2codepoint
+from collections import OrderedDict
+
+import helper
+from settings import config
+
+
+class RenderJob:
+    """a message part that waits to be rendered by a mailcap handler"""
+    def __init__(self, handler, payload, ctype, fallback=u''):
+        """
+        :param handler: mailcap command line
+        :type handler: str
+        :param payload: the data to render
+        :type payload: str
+        :param ctype: content type of the part
+        :type ctype: str
+        :param fallback: text to display if the handler fails
+        :type fallback: unicode
+        """
+        self.handler = handler
+        self.payload = payload
+        self.ctype = ctype
+        self.fallback = fallback
+
+    def finish(self, rendered):
+        """returns the text to display for the output of the handler"""
+        if rendered:  # handler had output
+            return unicode(rendered.strip(), encoding='utf8',
+                           errors='replace')
+        return self.fallback
+
+
+# tags that start a new paragraph
+BLOCK_TAGS = set(['p', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table',
+                  'blockquote', 'pre', 'ul', 'ol', 'dl', 'hr', 'form',
+                  'address', 'center', 'fieldset'])
+# tags whose content is not displayed
+SKIPPED_TAGS = set(['script', 'style', 'head', 'title'])
+
+
+class HTMLTextRenderer(HTMLParser.HTMLParser):
+    """
+    turns html into plain text in a single pass, without building a
+    document tree. Blocks are separated by empty lines, lists are indented
+    and get bullets or numbers, blockquotes are quoted with "> " and link
+    targets are listed as footnotes.
+    """
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.lines = []  # finished lines
+        self.cur = u''  # the current line
+        self.indent = u''  # indentation of the current line
+        self.space = False  # whether a space is pending
+        self.skip = 0  # depth of tags whose content is dropped
+        self.pre = 0  # depth of preformatted blocks
+        self.quote = 0  # depth of blockquotes
+        self.lists = []  # counters of open lists, None if unordered
+        self.links = []  # link targets, in order of appearance
+        self.link = None  # (href, start of link text) of the open link
+
+    def _newline(self):
+        """ends the current line"""
+        line = u'> ' * self.quote + self.indent + self.cur
+        self.lines.append(line.rstrip())
+        self.cur = u''
+        self.indent = u'  ' * len(self.lists)
+        self.space = False
+
+    def _block(self):
+        """ends the current paragraph"""
+        if self.cur:
+            self._newline()
+        if self.lines and self.lines[-1].strip('> '):
+            self.lines.append(u'> ' * self.quote)
+            self.lines[-1] = self.lines[-1].rstrip()
+        self.indent = u'  ' * len(self.lists)
+        self.space = False
+
+    def _write(self, text):
+        if self.pre:
+            lines = text.split('\n')
+            self.cur += lines[0]
+            for line in lines[1:]:
+                self._newline()
+                self.cur = line
+            return
+        words = text.split()
+        if not words:
+            self.space = self.space or bool(text)
+            return
+        if text[0].isspace():
+            self.space = True
+        for word in words:
+            if self.space and self.cur and not self.cur.endswith(' '):
+                self.cur += u' '
+            self.cur += word
+            self.space = True
+        self.space = text[-1].isspace()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skip += 1
+        if self.skip:
+            return
+        attrs = dict(attrs)
+        if tag in ('ul', 'ol') and self.lists:  # nested lists are compact
+            if self.cur:
+                self._newline()
+        elif tag in BLOCK_TAGS:
+            self._block()
+        if tag == 'br':
+            self._newline()
+        elif tag == 'hr':
+            self.lines.append(u'-' * 20)
+            self._block()
+        elif tag == 'blockquote':
+            self.quote += 1
+        elif tag == 'pre':
+            self.pre += 1
+        elif tag == 'ul':
+            self.lists.append(None)
+            self.indent = u'  ' * len(self.lists)
+        elif tag == 'ol':
+            try:
+                self.lists.append(int(attrs.get('start', 1)))
+            except ValueError:
+                self.lists.append(1)
+            self.indent = u'  ' * len(self.lists)
+        elif tag == 'li':
+            if self.cur:
+                self._newline()
+            self.indent = u'  ' * max(0, len(self.lists) - 1)
+            if self.lists and self.lists[-1] is not None:
+                self.cur = u'%d. ' % self.lists[-1]
+                self.lists[-1] += 1
+            else:
+                self.cur = u'* '
+        elif tag in ('tr', 'dt', 'dd'):
+            if self.cur:
+                self._newline()
+        elif tag in ('td', 'th'):
+            self.space = True
+        elif tag == 'a' and attrs.get('href'):
+            self.link = (attrs['href'], len(self.lines), len(self.cur))
+        elif tag == 'img' and attrs.get('alt'):
+            self._write(u'[%s]' % attrs['alt'])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in ('br', 'hr', 'img'):
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skip = max(0, self.skip - 1)
+            return
+        if self.skip:
+            return
+        if tag in ('ul', 'ol') and len(self.lists) > 1:
+            if self.cur:
+                self._newline()
+        elif tag == 'blockquote':
+            if self.cur:
+                self._newline()
+            if self.lines and not self.lines[-1].strip('> '):
+                self.lines.pop()
+            self.quote = max(0, self.quote - 1)
+            self._block()
+        elif tag in BLOCK_TAGS:
+            self._block()
+        if tag == 'pre':
+            self.pre = max(0, self.pre - 1)
+        elif tag in ('ul', 'ol') and self.lists:
+            self.lists.pop()
+            self.indent = u'  ' * len(self.lists)
+        elif tag in ('li', 'tr') and self.cur:
+            self._newline()
+        elif tag == 'a' and self.link:
+            href, line, col = self.link
+            self.link = None
+            if line == len(self.lines):
+                text = self.cur[col:].strip()
+            else:
+                text = None  # spans lines, always show the target
+            if text != href and not href.startswith('#'):
+                self.links.append(href)
+                self.space = True
+                self._write(u'[%d]' % len(self.links))
+
+    def handle_data(self, data):
+        if not self.skip:
+            self._write(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in 'xX':
+                char = unichr(int(name[1:], 16))
+            else:
+                char = unichr(int(name))
+        except (ValueError, OverflowError):
+            char = u'&#%s;' % name
+        self.handle_data(char)
+
+    def get_text(self):
+        """returns the text rendered so far, followed by the link
+        targets"""
+        lines = list(self.lines)
+        if self.cur:
+            lines.append(u'> ' * self.quote + self.indent + self.cur)
+        while lines and not lines[-1]:
+            lines.pop()
+        if self.links:
+            lines.append(u'')
+            for num, href in enumerate(self.links):
+                lines.append(u'[%d] %s' % (num + 1, href))
+        return u'\n'.join(lines).strip('\n')
+
+
+def render_html(html):
+    """returns the plain text rendering of html using
+    :class:`HTMLTextRenderer`
+
+    :param html: the html to render
+    :type html: unicode
+    :rtype: unicode
+    """
+    renderer = HTMLTextRenderer()
+    try:
+        renderer.feed(html)
+        renderer.close()
+    except HTMLParser.HTMLParseError, e:  # keep what we got so far
+        logging.info('rendering html failed: %s' % e)
+    return renderer.get_text()
+
+
+class RenderCache:
+    """
+    content addressed cache of rendered message parts on disk. Entries are
+    keyed by a hash of the payload and the command that rendered it, so
+    they never go stale. Least recently used entries are removed once the
+    files in the cache directory exceed the budget.
+    """
+    def __init__(self, path, budget):
+        """
+        :param path: directory to store entries in, created if missing
+        :type path: str
+        :param budget: maximal size of all entries in bytes
+        :type budget: int
+        """
+        self.path = path
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self._entries = None  # maps keys to sizes, read upon first use
+
+    def _load(self):
+        """reads the entries from disk, oldest first"""
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        found = []
+        for name in os.listdir(self.path):
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            found.append((st.st_mtime, name, st.st_size))
+        found.sort()
+        for mtime, name, size in found:
+            self._entries[name] = size
+            self.size += size
+
+    def key(self, command, payload):
+        """returns the cache key for payload rendered by command"""
+        digest = hashlib.sha1(command)
+        digest.update('\0')
+        digest.update(payload)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """returns the cached rendering for key or None"""
+        with self.lock:
+            self._load()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            filename = os.path.join(self.path, key)
+            try:
+                f = open(filename)
+                data = f.read()
+                f.close()
+                os.utime(filename, None)  # mark as recently used on disk
+            except (IOError, OSError):  # removed by someone else
+                self.size -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """stores data for key, evicting old entries if the budget is
+        exceeded"""
+        if len(data) > self.budget:
+            return
+        with self.lock:
+            self._load()
+            try:
+                fd, tmpname = tempfile.mkstemp(dir=self.path, prefix='.')
+                os.write(fd, data)
+                os.close(fd)
+                os.rename(tmpname, os.path.join(self.path, key))
+            except (IOError, OSError):
+                return
+            self.size -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self.size += len(data)
+            while self.size > self.budget:
+                oldest, size = self._entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+                try:
+                    os.unlink(os.path.join(self.path, oldest))
+                except OSError:
+                    pass
+
+    def get_stats(self):
+        """returns a dict with hit, miss and eviction counters as well as
+        the number of entries and their size in bytes"""
+        with self.lock:
+            self._load()
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'size': self.size, 'budget': self.budget}
+
+
+_cache = None
+
+
+def get_render_cache():
+    """returns the :class:`RenderCache` set up in the config, or None if
+    render_cache_size is 0"""
+    global _cache
+    if _cache is None:
+        budget = config.getint('general', 'render_cache_size') * 1024 * 1024
+        if not budget:
+            return None
+        path = os.path.expanduser(config.get('general', 'render_cache_dir'))
+        _cache = RenderCache(path, budget)
+    return _cache
+
+
+def render_external(handler, payload, timeout=None):
+    """
+    renders payload with a mailcap handler. The payload is written to a
+    tempfile, as not all handlers accept stuff from stdin. Output is looked
+    up in and stored to the render cache.
+
+    :param handler: mailcap command line, `%s` is replaced by the filename
+    :type handler: str
+    :param payload: the data to render
+    :type payload: str
+    :param timeout: seconds after which the handler is killed
+    :type timeout: int
+    :returns: output of the handler or None if it failed
+    """
+    cache = get_render_cache()
+    if cache:
+        rendered = cache.get(cache.key(handler, payload))
+        if rendered is not None:
+            return rendered
+    return run_handler(handler, payload, timeout)
+
+
+def run_handler(handler, payload, timeout=None):
+    """like :func:`render_external` but only stores to the render cache,
+    for callers that did the lookup themselves"""
+    tmpfile = tempfile.NamedTemporaryFile(delete=False, suffix='.html')
+    tmpfile.write(payload)
+    tmpfile.close()
+    rendered = helper.cmd_output(handler % tmpfile.name, timeout=timeout)
+    os.unlink(tmpfile.name)
+    cache = get_render_cache()
+    if cache and rendered:
+        cache.put(cache.key(handler, payload), rendered)
+    return rendered
+
+
+class RendererPool:
+    """
+    renders parts with mailcap handlers in a fixed number of worker
+    threads. Finished job ids are written to report_fd, which the ui
+    watches to call :meth:`deliver` from its main loop.
+    """
+    def __init__(self, report_fd, workers=4, timeout=10):
+        """
+        :param report_fd: writable end of a pipe watched by the main loop
+        :type report_fd: int
+        :param workers: number of concurrent renders
+        :type workers: int
+        :param timeout: seconds after which a handler is killed
+        :type timeout: int
+        """
+        self.report_fd = report_fd
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {}  # maps job ids to (job, callback) pairs
+        self.finished = {}  # maps job ids to handler output
+        self._next_id = 0
+        for i in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def render(self, job, callback):
+        """
+        renders job in the background. Cached renderings are returned
+        right away, otherwise callback is called with the text to display
+        once the handler finished.
+
+        :param job: the part to render
+        :type job: :class:`RenderJob`
+        :param callback: called with a unicode string in the main loop
+        :type callback: callable
+        :returns: the text to display if it is cached, None otherwise
+        """
+        cache = get_render_cache()
+        if cache:
+            rendered = cache.get(cache.key(job.handler, job.payload))
+            if rendered is not None:
+                return job.finish(rendered)
+        jobid = self._next_id
+        self._next_id += 1
+        self.pending[jobid] = (job, callback)
+        self.queue.put((jobid, job))
+        return None
+
+    def _work(self):
+        while True:
+            jobid, job = self.queue.get()
+            try:
+                rendered = run_handler(job.handler, job.payload,
+                                       timeout=self.timeout)
+            except Exception, e:
+                logging.error('rendering %s failed: %s' % (job.ctype, e))
+                rendered = None
+            with self.lock:
+                self.finished[jobid] = rendered
+            os.write(self.report_fd, '%d\n' % jobid)
+
+    def deliver(self, data):
+        """calls the callbacks of the jobs whose ids are in data"""
+        for line in data.splitlines():
+            jobid = int(line)
+            with self.lock:
+                rendered = self.finished.pop(jobid)
+            job, callback = self.pending.pop(jobid)
+            callback(job.finish(rendered))
+
+
+pool = None  # the RendererPool of the ui, if there is one
@@ -38,10 +38,20 @@ DEFAULTS = {
         'notify_timeout': '2',
         'show_statusbar': 'True',
         'flush_retry_timeout': '5',
+        'flush_retry_max_timeout': '60',
         'hooksfile': '~/.alot.py',
         'bug_on_exit': 'False',
         'timestamp_format': '',
         'print_cmd': 'muttprint',
+        'query_cache_size': '16',
+        'render_cache_dir': '~/.cache/alot/render',
+        'render_cache_size': '32',
+        'render_workers': '4',
+        'render_timeout': '10',
+        'html_renderer': 'mailcap',
+        'parsed_email_cache_size': '32',
+        'snippet_cache': '~/.cache/alot/snippets',
+        'threadline_columns': 'date,authors,mailcount,tags,subject,content',
     },
     '16c-theme': {
         'bufferlist_focus_bg': 'dark gray',
@@ -302,6 +312,7 @@ NOTMUCH_DEFAULTS = {
 class DefaultsConfigParser(SafeConfigParser):
     def __init__(self, defaults):
         self.defaults = defaults
+        self.generation = 0  # changes whenever the config does
         SafeConfigParser.__init__(self)
         self.optionxform = lambda x: x
         for sec in defaults.keys():
@@ -315,6 +326,10 @@ class DefaultsConfigParser(SafeConfigParser):
                 return self.defaults[section][option]
         return fallback
 
+    def set(self, section, option, value=None):
+        SafeConfigParser.set(self, section, option, value)
+        self.generation += 1
+
     def has_option(self, section, option, *args, **kwargs):
         if SafeConfigParser.has_option(self, section, option):
             return True
@@ -338,6 +353,7 @@ class AlotConfigParser(DefaultsConfigParser):
             return
 
         SafeConfigParser.readfp(self, codecs.open(file, "r", "utf8"))
+        self.generation += 1
         if self.has_option('general', 'hooksfile'):
             hf = os.path.expanduser(self.get('general', 'hooksfile'))
             if hf is not None:
@@ -0,0 +1,153 @@
+"""
+This file is part of alot.
+
+Alot is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Alot is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
+"""
+import os
+import atexit
+import anydbm
+import logging
+
+import render
+from mailsource import get_source
+from settings import config
+
+SNIPPET_LENGTH = 200  # characters kept per message
+SNIPPET_READ_SIZE = 8 * 1024  # encoded bytes read to extract a snippet
+SYNC_INTERVAL = 50  # new snippets after which the index is written out
+
+
+def extract_snippet(path, length=SNIPPET_LENGTH):
+    """
+    returns the leading text of the message file at path, with whitespace
+    collapsed and quoted lines dropped. Only the beginning of the first
+    text part is read and decoded.
+
+    :param path: path to the message file
+    :type path: str
+    :param length: maximal length of the snippet
+    :type length: int
+    :rtype: unicode
+    """
+    textparts = [p for p in get_source(path).walk()
+                 if not p.is_multipart() and p.get_content_maintype() == 'text']
+    if not textparts:
+        return u''
+    plain = [p for p in textparts if p.get_content_type() == 'text/plain']
+    part = (plain or textparts)[0]
+    data = ''
+    for chunk in part.iter_decoded_payload(SNIPPET_READ_SIZE):
+        data += chunk
+        if len(data) >= SNIPPET_READ_SIZE:
+            break
+    try:
+        text = data.decode(part.get_content_charset() or 'ascii', 'replace')
+    except LookupError:  # unknown charset
+        text = data.decode('ascii', 'replace')
+    if part.get_content_type() == 'text/html':
+        text = render.render_html(text)
+    lines = [l for l in text.splitlines() if not l.lstrip().startswith('>')]
+    return u' '.join(u' '.join(lines).split())[:length]
+
+
+class SnippetIndex:
+    """
+    persistent map from message ids to snippets of their text. An entry
+    records the mtime of the message file it was extracted from, and is
+    extracted again once the file changes.
+    """
+    def __init__(self, path):
+        """
+        :param path: file name of the index, created if missing
+        :type path: str
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._unsynced = 0
+        self._db = None  # opened upon first use
+
+    def _open(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = anydbm.open(self.path, 'c')
+        return self._db
+
+    def get(self, mid, path):
+        """
+        returns the snippet of a message
+
+        :param mid: message id
+        :type mid: str
+        :param path: path to the message file
+        :type path: str
+        :rtype: unicode
+        """
+        db = self._open()
+        key = mid.encode('utf-8')
+        try:
+            mtime = '%d' % os.stat(path).st_mtime
+        except OSError:
+            return u''
+        entry = db.get(key)
+        if entry is not None:
+            recorded, _, snippet = entry.partition('\0')
+            if recorded == mtime:
+                self.hits += 1
+                return snippet.decode('utf-8')
+        self.misses += 1
+        try:
+            snippet = extract_snippet(path)
+        except (IOError, OSError), e:
+            logging.info('no snippet for %s: %s' % (mid, e))
+            return u''
+        db[key] = mtime + '\0' + snippet.encode('utf-8')
+        self._unsynced += 1
+        if self._unsynced >= SYNC_INTERVAL:
+            self.sync()
+        return snippet
+
+    def sync(self):
+        """writes new entries to disk"""
+        if self._db is not None and hasattr(self._db, 'sync'):
+            self._db.sync()
+        self._unsynced = 0
+
+    def close(self):
+        """writes new entries to disk and closes the index"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get_stats(self):
+        """returns a dict with hit and miss counters"""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_index = None
+
+
+def get_snippet_index():
+    """returns the :class:`SnippetIndex` stored at the snippet_cache
+    path"""
+    global _index
+    if _index is None:
+        path = os.path.expanduser(config.get('general', 'snippet_cache'))
+        _index = SnippetIndex(path)
+        atexit.register(_index.close)
+    return _index
@@ -21,6 +21,8 @@ import os
 from urwid.command_map import command_map
 
 from settings import config
+from db import FlushWorker
+import render
 from buffer import BufferlistBuffer
 from command import commandfactory
 from command import interpret_commandline
@@ -69,6 +71,23 @@ class UI:
         self.mode = ''
         self.commandprompthistory = []
 
+        # writes to the index happen in the background
+        self.flush_status = None
+        self.flush_callbacks = []
+        report_fd = self.mainloop.watch_pipe(self._handle_flush_report)
+        timeout = config.getint('general', 'flush_retry_timeout')
+        max_timeout = config.getint('general', 'flush_retry_max_timeout')
+        self.flushworker = FlushWorker(dbman, report_fd, timeout=timeout,
+                                       max_timeout=max_timeout)
+        self.flushworker.start()
+
+        # parts are rendered by mailcap handlers in the background
+        report_fd = self.mainloop.watch_pipe(self._handle_render_report)
+        workers = config.getint('general', 'render_workers')
+        timeout = config.getint('general', 'render_timeout')
+        render.pool = render.RendererPool(report_fd, workers=workers,
+                                          timeout=timeout)
+
         self.logger.debug('setup bindings')
         cmd = commandfactory('search', query=initialquery)
         self.apply_command(cmd)
@@ -77,6 +96,47 @@ class UI:
     def keypress(self, key):
         self.logger.debug('unhandeled input: %s' % key)
 
+    def flush(self, callback=None):
+        """hands pending writes to the background flush worker
+
+        :param callback: called once the write queue has been committed
+        :type callback: callable
+        """
+        if callback:
+            self.flush_callbacks.append(callback)
+        self.flushworker.wakeup()
+
+    def _handle_flush_report(self, data):
+        """interprets status lines written by the flush worker"""
+        for line in data.splitlines():
+            report, _, args = line.partition(' ')
+            self.logger.debug('flush worker: %s' % line)
+            if report == 'progress':
+                written, total = args.split()
+                self.flush_status = 'flushing %s/%s' % (written, total)
+            elif report == 'locked':
+                self.flush_status = 'index locked'
+                self.notify('index locked, will try again in %s secs' % args)
+            elif report == 'done':
+                self.flush_status = None
+                if not self.dbman.writequeue:
+                    callbacks = self.flush_callbacks
+                    self.flush_callbacks = []
+                    for callback in callbacks:
+                        callback()
+            elif report == 'error':
+                self.flush_status = None
+                # the writes they waited for did not happen
+                self.flush_callbacks = []
+                self.notify('flushing failed: %s' % args, priority='error')
+        self.update()
+        return True
+
+    def _handle_render_report(self, data):
+        """hands parts rendered in the background to their widgets"""
+        render.pool.deliver(data)
+        return True
+
     def prompt(self, prefix='>', text=u'', completer=None, tab=0, history=[]):
         """prompt for text input
 
@@ -366,6 +426,8 @@ class UI:
         pending_writes = len(self.dbman.writequeue)
         if pending_writes > 0:
             righttxt = ('|' * pending_writes) + ' ' + righttxt
+        if self.flush_status:
+            righttxt = '[%s] %s' % (self.flush_status, righttxt)
         footerright = urwid.Text(righttxt, align='right')
         columns = urwid.Columns([
             footerleft,
@@ -78,3 +78,178 @@ class IteratorWalker(urwid.ListWalker):
 
     def get_lines(self):
         return self.lines
+
+
+class PagingWalker(urwid.ListWalker):
+    """
+    walks the threads that match a query. Threads are fetched in pages via
+    :meth:`alot.db.ResultIndex.get_threads` when they are first needed, so
+    any position can be focussed without walking everything before it.
+    Positions are offsets in the search result, which the walker keeps for
+    its lifetime: writes to the index do not shift them.
+    """
+    def __init__(self, result, containerclass, pagesize=50, **kwargs):
+        """
+        :param result: the search result, see
+                       :meth:`alot.db.DBManager.get_result_index`
+        :type result: alot.db.ResultIndex
+        :param containerclass: widget class to wrap the threads in, called
+                               with the thread and kwargs
+        :type containerclass: class
+        :param pagesize: number of threads fetched at once
+        :type pagesize: int
+        """
+        self.result = result
+        self.containerclass = containerclass
+        self.pagesize = pagesize
+        self.kwargs = kwargs
+        self.widgets = {}  # maps offsets to widgets
+        self.removed = set()  # offsets of removed or vanished threads
+        self.focus = 0
+
+    def __len__(self):
+        count = len(self.result)
+        return count - len([o for o in self.removed if o < count])
+
+    def get_focus(self):
+        widget, pos = self._get_at_pos(self.focus, 1)
+        if widget is None:
+            # the focus may lie beyond the end of a shrunken result
+            self.focus = max(min(self.focus, len(self.result) - 1), 0)
+            widget, pos = self._get_at_pos(self.focus, -1)
+        return widget, pos
+
+    def set_focus(self, focus):
+        self.focus = max(focus, 0)
+        self._modified()
+
+    def set_focus_last(self):
+        """focusses the last thread of the result"""
+        self.set_focus(len(self.result) - 1)
+
+    def get_next(self, start_from):
+        return self._get_at_pos(start_from + 1, 1)
+
+    def get_prev(self, start_from):
+        return self._get_at_pos(start_from - 1, -1)
+
+    def remove(self, obj):
+        for offset, widget in self.widgets.items():
+            if widget is obj:
+                del self.widgets[offset]
+                self.removed.add(offset)
+        self._modified()
+
+    def _get_at_pos(self, pos, step):
+        """returns the widget at pos, skipping removed positions in
+        direction step"""
+        while pos >= 0:
+            if pos in self.removed:
+                pos += step
+            elif pos in self.widgets:
+                return (self.widgets[pos], pos)
+            elif not self._fetch(pos):  # pos beyond end of result
+                return (None, None)
+        return (None, None)
+
+    def _fetch(self, pos):
+        """loads the page that contains pos, returns False if it is empty"""
+        start = pos - pos % self.pagesize
+        threads = self.result.get_threads(start, self.pagesize)
+        for offset, thread in enumerate(threads, start):
+            if offset in self.widgets or offset in self.removed:
+                continue
+            if thread is None:
+                self.removed.add(offset)
+            else:
+                widget = self.containerclass(thread, **self.kwargs)
+                self.widgets[offset] = widget
+        return len(threads) > pos - start
+
+    def get_lines(self):
+        """returns the widgets fetched so far in result order"""
+        return [self.widgets[o] for o in sorted(self.widgets)]
+
+
+class ThreadWalker(urwid.ListWalker):
+    """
+    walks the messages of a thread in the depth-first order of its
+    :class:`alot.db.ThreadTree`. Message widgets are only created once they
+    are needed, which is when they scroll into view. Their depth and the
+    bars drawn in front of them are read off the tree arrays. Positions are
+    indices into the tree.
+    """
+    def __init__(self, tree, containerclass, **kwargs):
+        """
+        :param tree: reply structure of the thread
+        :type tree: alot.db.ThreadTree
+        :param containerclass: widget class to wrap the messages in, called
+                               with the message, even, depth, bars_at,
+                               folded and kwargs
+        :type containerclass: class
+        """
+        self.tree = tree
+        self.containerclass = containerclass
+        self.kwargs = kwargs
+        self.widgets = {}  # maps positions to widgets
+        self.unfolded = set()  # positions to create unfolded widgets for
+        self.focus = 0
+
+    def __len__(self):
+        return len(self.tree)
+
+    def get_focus(self):
+        return self._get_at_pos(self.focus)
+
+    def set_focus(self, focus):
+        self.focus = focus
+        self._modified()
+
+    def get_next(self, start_from):
+        return self._get_at_pos(start_from + 1)
+
+    def get_prev(self, start_from):
+        return self._get_at_pos(start_from - 1)
+
+    def _get_at_pos(self, pos):
+        if pos < 0 or pos >= len(self.tree):
+            return (None, None)
+        return (self.get_widget(pos), pos)
+
+    def get_widget(self, pos):
+        """returns the widget for the message at pos, creating it if
+        needed"""
+        widget = self.widgets.get(pos)
+        if widget is None:
+            widget = self.containerclass(self.tree.messages[pos],
+                                         even=(pos % 2 == 0),
+                                         depth=self.tree.depth[pos],
+                                         bars_at=self.get_bars(pos),
+                                         folded=(pos not in self.unfolded),
+                                         **self.kwargs)
+            self.widgets[pos] = widget
+        return widget
+
+    def get_bars(self, pos):
+        """
+        returns for the message at pos and each of its ancestors whether a
+        sibling follows it, ordered from the toplevel message down
+        """
+        bars = []
+        while pos != -1:
+            bars.append(self.tree.next_sibling[pos] != -1)
+            pos = self.tree.parent[pos]
+        bars.reverse()
+        return bars
+
+    def unfold(self, pos):
+        """unfolds the message at pos, or the widget for it once it is
+        created"""
+        if pos in self.widgets:
+            self.widgets[pos].fold(visible=True)
+        else:
+            self.unfolded.add(pos)
+
+    def get_lines(self):
+        """returns the widgets for all messages, creating missing ones"""
+        return [self.get_widget(pos) for pos in xrange(len(self.tree))]
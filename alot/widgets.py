@@ -17,6 +17,7 @@ along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
 Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
 """
 import email
+import bisect
 import urwid
 from urwid.command_map import command_map
 import logging
@@ -25,31 +26,52 @@ from settings import config
 from helper import shorten_author_string 
 from helper import pretty_datetime
 import message
+import render
+from snippet import SNIPPET_LENGTH
 
-class ThreadlineWidget(urwid.AttrMap):
-    def __init__(self, tid, dbman):
-        self.dbman = dbman
-        self.thread = dbman.get_thread(tid)
-        self.tag_widgets = []
-        self.display_content = config.getboolean('general',
-                                    'display_content_in_threadline')
-        self.rebuild()
-        urwid.AttrMap.__init__(self, self.columns,
-                               'threadline', 'threadline_focus')
+THREADLINE_COLUMNS = ['date', 'authors', 'mailcount', 'tags', 'subject',
+                      'content']
 
-    def rebuild(self):
-        cols = []
-        # DATE
-        formatstring = config.get('general', 'timestamp_format')
-        newest = self.thread.get_newest_date()
-        if formatstring:
-            datestring = newest.strftime(formatstring)
-        else:
-            datestring = pretty_datetime(newest).rjust(10)
-        self.date_w = urwid.AttrMap(urwid.Text(datestring), 'threadline_date')
 
+class ThreadlineLayout:
+    """
+    the threadline settings, read from the config once and shared by all
+    :class:`ThreadlineWidget` objects. The `threadline_columns` option
+    lists the columns in display order, each optionally followed by a
+    fixed width, as in "date:10,authors,subject".
+    """
+    def __init__(self):
+        self.generation = config.generation
+        self.timestamp_format = config.get('general', 'timestamp_format')
+        self.authors_maxlength = config.getint('general', 'authors_maxlength')
+        display_content = config.getboolean('general',
+                                            'display_content_in_threadline')
+        self.columns = []  # pairs of column name and width or None
+        for entry in config.getstringlist('general', 'threadline_columns'):
+            name, _, width = entry.partition(':')
+            if name not in THREADLINE_COLUMNS:
+                continue
+            if name == 'content' and not display_content:
+                continue
+            try:
+                width = int(width)
+            except ValueError:
+                width = None
+            self.columns.append((name, width))
+        # without own widths, authors and mailcount share authors_maxlength
+        self.share_authors = (('authors', None) in self.columns and
+                              ('mailcount', None) in self.columns)
+
+    def segments(self, thread):
+        """
+        returns the columns of the line for thread as list of triples of
+        attribute, focus attribute and text
+
+        :param thread: the thread to summarize
+        :type thread: alot.db.Thread
+        """
         # SIZE
-        thread_size = self.thread.get_total_messages()
+        thread_size = thread.get_total_messages()
         # Show number of messages only if there are at least 2 mails
         # (save space in the line)
         if thread_size>1 and thread_size<=20:
@@ -60,84 +82,119 @@ class ThreadlineWidget(urwid.AttrMap):
         else:
             mailcountstring = " "
 
-        # TAGS
-        tags = self.thread.get_tags()
-        tags.sort()
-        tagstrings = []
-        for tag in tags:
-            tw = TagWidget(tag)
-            self.tag_widgets.append(tw)
-            tagstrings.append(('fixed', tw.width(), tw))
-            
         # AUTHORS
-        authors_string = self.thread.get_authors() or '(None)'
-        maxlength = config.getint('general', 'authors_maxlength')
-        authorsstring = shorten_author_string(authors_string, maxlength - len(mailcountstring))
-        offset = maxlength - len(authorsstring)
-        mailcountstring = mailcountstring.rjust(offset)
-        self.mailcount_w = urwid.AttrMap(urwid.Text(mailcountstring),
-                                   'threadline_mailcount')
-
-        self.authors_w = urwid.AttrMap(urwid.Text(authorsstring),
-                                       'threadline_authors')
-
-        # SUBJECT
-        subjectstring = self.thread.get_subject().strip()
-        self.subject_w = urwid.AttrMap(urwid.Text(subjectstring, wrap='clip'),
-                                 'threadline_subject')
-
-        # BODY
-        if self.display_content:
-            msgs = self.thread.get_messages().keys()
-            msgs.sort()
-            lastcontent = ' '.join([m.get_text_content() for m in msgs])
-            contentstring = lastcontent.replace('\n', ' ').strip()
-            self.content_w = urwid.AttrMap(urwid.Text(contentstring,
-                                                      wrap='clip'),
-                                           'threadline_content')
-
-        # Set column order
-        #self.select = urwid.AttrMap(urwid.Text("[ ] ", wrap='clip'),
-        #                            'threadline_subject')
-        #cols.append(('fixed', 4, self.select))
-        cols.append(('fixed', len(datestring), self.date_w))
-        cols.append(('fixed', len(authorsstring), self.authors_w))
-        cols.append(('fixed', len(mailcountstring), self.mailcount_w))
-
-        cols.extend(tagstrings)
-
-        if subjectstring:
-            cols.append(('fixed', len(subjectstring), self.subject_w))
-        if self.display_content:
-            cols.append(self.content_w)
-
-        self.columns = urwid.Columns(cols, dividechars=1)
-        self.original_widget = self.columns
+        authors_string = thread.get_authors() or '(None)'
+        if self.share_authors:
+            authorsstring = shorten_author_string(authors_string,
+                    self.authors_maxlength - len(mailcountstring))
+            offset = self.authors_maxlength - len(authorsstring)
+            mailcountstring = mailcountstring.rjust(offset)
+
+        segments = []
+        for name, width in self.columns:
+            if name == 'date':
+                newest = thread.get_newest_date()
+                if self.timestamp_format:
+                    text = newest.strftime(self.timestamp_format)
+                else:
+                    text = pretty_datetime(newest).rjust(10)
+            elif name == 'authors':
+                if self.share_authors:
+                    text = authorsstring
+                else:
+                    text = shorten_author_string(authors_string,
+                            width or self.authors_maxlength)
+            elif name == 'mailcount':
+                text = mailcountstring
+            elif name == 'tags':
+                for tag in thread.get_tags():
+                    style = get_tag_style(tag)
+                    segments.append((style.attr, style.focus_attr,
+                                     style.translated))
+                continue
+            elif name == 'subject':
+                text = thread.get_subject().strip()
+                if not text and not width:
+                    continue
+            elif name == 'content':
+                # snippets of the first messages, enough to fill the line
+                text = thread.get_snippet(SNIPPET_LENGTH)
+            if width:
+                text = text[:width].ljust(width)
+            segments.append(('threadline_' + name,
+                             'threadline_%s_focus' % name, text))
+        return segments
+
+
+_layout = None
+
+
+def get_threadline_layout():
+    """returns the :class:`ThreadlineLayout` for the current config,
+    compiling it again if the config changed"""
+    global _layout
+    if _layout is None or _layout.generation != config.generation:
+        _layout = ThreadlineLayout()
+    return _layout
+
+
+class ThreadlineWidget(urwid.Widget):
+    """
+    one line summary of a thread. Date, authors, message count, tags,
+    subject and content are laid out as a single styled text row. The
+    rendered canvases are kept for both focus states per width, so that
+    moving the focus does not restyle anything.
+    """
+    _sizing = frozenset(['flow'])
+    _selectable = True
 
-    def render(self, size, focus=False):
-        if focus:
-            self.date_w.set_attr_map({None: 'threadline_date_focus'})
-            self.mailcount_w.set_attr_map({None:
-                                           'threadline_mailcount_focus'})
-            for tw in self.tag_widgets:
-                tw.set_focussed()
-            self.authors_w.set_attr_map({None: 'threadline_authors_focus'})
-            self.subject_w.set_attr_map({None: 'threadline_subject_focus'})
-            if self.display_content:
-                self.content_w.set_attr_map({None: 'threadline_content_focus'})
-        else:
-            self.date_w.set_attr_map({None: 'threadline_date'})
-            self.mailcount_w.set_attr_map({None: 'threadline_mailcount'})
-            for tw in self.tag_widgets:
-                tw.set_unfocussed()
-            self.authors_w.set_attr_map({None: 'threadline_authors'})
-            self.subject_w.set_attr_map({None: 'threadline_subject'})
-            if self.display_content:
-                self.content_w.set_attr_map({None: 'threadline_content'})
-        return urwid.AttrMap.render(self, size, focus)
+    def __init__(self, thread, dbman):
+        """
+        :param thread: the thread to summarize
+        :type thread: alot.db.Thread
+        :param dbman: db manager that is used for further lookups
+        :type dbman: alot.db.DBManager
+        """
+        self.dbman = dbman
+        self.thread = thread
+        self.rebuild()
 
-    def selectable(self):
-        return True
+    def rebuild(self):
+        """re-reads the thread data and redraws the line"""
+        segments = get_threadline_layout().segments(self.thread)
+        self.markup = []
+        self.focus_markup = []
+        for attr, focus_attr, text in segments:
+            if isinstance(text, str):
+                # dates come in the encoding of the locale, and str and
+                # unicode can not be mixed in one markup
+                text = text.decode(urwid.util.detected_encoding or 'ascii',
+                                   'replace')
+            if self.markup:
+                self.markup.append(('threadline', u' '))
+                self.focus_markup.append(('threadline_focus', u' '))
+            self.markup.append((attr, text))
+            self.focus_markup.append((focus_attr, text))
+        self._canvases = {}  # maps (width, focus) pairs to canvases
+        self._invalidate()
+
+    def rows(self, size, focus=False):
+        return 1
+
+    def render(self, size, focus=False):
+        key = (size[0], focus)
+        canvas = self._canvases.get(key)
+        if canvas is None:
+            if focus:
+                markup = self.focus_markup
+            else:
+                markup = self.markup
+            # the map styles the padding after the text as well
+            line = urwid.AttrMap(urwid.Text(markup, wrap='clip'),
+                                 'threadline', 'threadline_focus')
+            canvas = line.render((size[0],), focus)
+            self._canvases[key] = canvas
+        return canvas
 
     def keypress(self, size, key):
         return key
@@ -162,27 +219,57 @@ class BufferlineWidget(urwid.Text):
         return self.buffer
 
 
-class TagWidget(urwid.AttrMap):
+class TagStyle:
+    """
+    how a tag is displayed: its translation, palette attributes and
+    display width. There is one instance per tag name, shared by all
+    widgets that show the tag, see :func:`get_tag_style`.
+    """
     def __init__(self, tag):
-
+        """
+        :param tag: name of the tag
+        :type tag: str
+        """
         self.tag = tag
+        self.translated = config.get('tag-translate', tag, fallback=tag)
+        self.attr = config.get_tagattr(tag)
+        self.focus_attr = config.get_tagattr(tag, focus=True)
+        # evil voodoo hotfix for double width chars that may
+        # lead e.g. to strings with length 1 that need width 2
+        self.width = urwid.Text(self.translated).pack()[0]
 
-        #self.translated = self.translated.encode('utf-8')
-        #self.txt = urwid.Text(self.translated, wrap='clip')
-        #normal = config.get_tagattr(tag)
 
-        normal = config.get_tagattr(tag)
-        focus = config.get_tagattr(tag, focus=True)
-        self.translated = config.get('tag-translate', tag, fallback=tag)
+_tag_styles = {}  # maps tag names to TagStyles
+_tag_styles_generation = None
+
+
+def get_tag_style(tag):
+    """returns the :class:`TagStyle` for tag. Styles are computed once per
+    tag name and again after the config changed."""
+    global _tag_styles_generation
+    if _tag_styles_generation != config.generation:
+        _tag_styles.clear()
+        _tag_styles_generation = config.generation
+    style = _tag_styles.get(tag)
+    if style is None:
+        style = _tag_styles[tag] = TagStyle(tag)
+    return style
+
+
+class TagWidget(urwid.AttrMap):
+    def __init__(self, tag):
+
+        self.tag = tag
+        self.style = get_tag_style(tag)
+        self.translated = self.style.translated
         self.txt = urwid.Text(self.translated)#, wrap='space')
+        normal = self.style.attr
         self.focus_palette = normal
         self.unfocus_palette = normal
         urwid.AttrMap.__init__(self, self.txt, self.unfocus_palette, self.focus_palette)
 
     def width(self):
-        # evil voodoo hotfix for double width chars that may
-        # lead e.g. to strings with length 1 that need width 2
-        return self.txt.pack()[0]
+        return self.style.width
 
     def selectable(self):
         return True
@@ -263,7 +350,7 @@ class MessageWidget(urwid.WidgetWrap):
         self.depth = depth
         self.bars_at = bars_at
         self.even = even
-        self.folded = folded
+        self.folded = True  # until unfolded below
 
         # build the summary line, header and body will be created on demand
         self.sumline = self._build_sum_line()
@@ -308,7 +395,8 @@ class MessageWidget(urwid.WidgetWrap):
         """creates/returns the widget that displays the mail header"""
         if not self.headerw:
             displayed = config.getstringlist('general', 'displayed_headers')
-            cols = [MessageHeaderWidget(self.message.get_email(), displayed)]
+            cols = [MessageHeaderWidget(self.message.get_headers(),
+                                        displayed)]
             bc = list()
             if self.depth:
                 cols.insert(0, self._get_spacer(self.bars_at[1:]))
@@ -334,7 +422,7 @@ class MessageWidget(urwid.WidgetWrap):
     def _get_body_widget(self):
         """creates/returns the widget that displays the mail body"""
         if not self.bodyw:
-            cols = [MessageBodyWidget(self.message.get_email())]
+            cols = [MessageBodyWidget(self.message.get_source())]
             bc = list()
             if self.depth:
                 cols.insert(0, self._get_spacer(self.bars_at[1:]))
@@ -491,8 +579,125 @@ class MessageBodyWidget(urwid.AttrMap):
     """displays printable parts of an email"""
 
     def __init__(self, msg):
-        bodytxt = message.extract_body(msg)
-        urwid.AttrMap.__init__(self, urwid.Text(bodytxt), 'message_body')
+        """
+        :param msg: the email to display
+        :type msg: :class:`~alot.mailsource.MessageSource` or
+                   email.message.Message
+        """
+        self.pieces = []
+        for piece in message.body_pieces(msg):
+            if isinstance(piece, render.RenderJob):
+                if render.pool:  # render in the background
+                    index = len(self.pieces)
+                    callback = lambda text, i=index: self._set_piece(i, text)
+                    text = render.pool.render(piece, callback)
+                    if text is None:
+                        text = u'[rendering %s]' % piece.ctype
+                    piece = text
+                else:
+                    piece = piece.finish(render.render_external(
+                        piece.handler, piece.payload))
+            self.pieces.append(piece)
+        self.textw = LineTextWidget(u''.join(self.pieces))
+        urwid.AttrMap.__init__(self, self.textw, 'message_body')
+
+    def _set_piece(self, index, text):
+        """replaces a placeholder once its part is rendered"""
+        self.pieces[index] = text
+        self.textw.set_text(u''.join(self.pieces))
+
+
+class LineTextWidget(urwid.Widget):
+    """
+    flow widget that displays text like :class:`urwid.Text`, but only lays
+    out the lines that are visible. The text is split into lines once, and
+    for the current width the first row of every line is recorded, so
+    that rendering a window of a long text does not depend on its length.
+    """
+    _sizing = frozenset(['flow'])
+    ignore_focus = True
+
+    def __init__(self, text):
+        """
+        :param text: the text to display
+        :type text: unicode
+        """
+        self.set_text(text)
+
+    def set_text(self, text):
+        self._lines = text.split('\n')
+        self._layout = None  # width and row offsets of the lines
+        self._invalidate()
+
+    def get_text(self):
+        return u'\n'.join(self._lines)
+
+    def line_offsets(self, maxcol):
+        """
+        returns the row each line starts at when wrapped to maxcol columns,
+        followed by the total number of rows
+        """
+        if self._layout is None or self._layout[0] != maxcol:
+            offsets = [0]
+            row = 0
+            for line in self._lines:
+                if urwid.calc_width(line, 0, len(line)) <= maxcol:
+                    row += 1
+                else:  # only lines that wrap need to be laid out
+                    row += len(urwid.default_layout.layout(line, maxcol,
+                                                           'left', 'space'))
+                offsets.append(row)
+            self._layout = (maxcol, offsets)
+        return self._layout[1]
+
+    def rows(self, size, focus=False):
+        return self.line_offsets(size[0])[-1]
+
+    def render(self, size, focus=False):
+        return LineTextCanvas(self, size[0], self.rows(size))
+
+    def render_rows(self, maxcol, top, count):
+        """
+        renders the lines that cover count rows starting with row top.
+        Returns the canvas and the row in it that corresponds to top.
+        """
+        offsets = self.line_offsets(maxcol)
+        first = bisect.bisect_right(offsets, top) - 1
+        last = bisect.bisect_left(offsets, top + count, first)
+        text = u'\n'.join(self._lines[first:last])
+        return urwid.Text(text).render((maxcol,)), top - offsets[first]
+
+
+class LineTextCanvas(urwid.Canvas):
+    """
+    canvas of a :class:`LineTextWidget`. The rows are rendered only when
+    the content is read, and only those that are not trimmed off.
+    """
+    def __init__(self, widget, cols, rows):
+        urwid.Canvas.__init__(self)
+        self.widget = widget
+        self.size = cols, rows
+        self.cursor = None
+
+    def cols(self):
+        return self.size[0]
+
+    def rows(self):
+        return self.size[1]
+
+    def content(self, trim_left=0, trim_top=0, cols=None, rows=None,
+                attr=None):
+        if not cols:
+            cols = self.size[0] - trim_left
+        if not rows:
+            rows = self.size[1] - trim_top
+        canvas, top = self.widget.render_rows(self.size[0], trim_top, rows)
+        return canvas.content(trim_left, top, cols, rows, attr)
+
+    def content_delta(self, other):
+        if other is self:
+            return [self.cols()] * self.rows()
+        return self.content()
 
 
 class AttachmentWidget(urwid.WidgetWrap):
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""
+This file is part of alot.
+
+Alot is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Alot is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
+"""
+# Compares the two ways text/html parts are displayed: the builtin
+# HTMLTextRenderer, and the copiousoutput mailcap handler that runs once
+# per part. Both render the same synthetic html mails. The render cache is
+# switched off, so every part reaches the handler.
+#
+# usage: python bench/html.py [number of mails] [handler]
+# The handler defaults to the text/html entry of the mailcap files, e.g.
+# "w3m -dump -T text/html '%s'".
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from alot import render
+from alot.settings import config, get_mime_handler
+
+WORDS = ['release', 'patch', 'meeting', 'notes', 'build', 'broken', 'review',
+         'draft', 'plan', 'question', 'update', 'bug', 'fix', 'docs', 'test']
+
+
+def generate_html(rnd):
+    """returns a html mail body of some paragraphs, a list, a table, a
+    quote and links"""
+    def text(count):
+        return ' '.join(rnd.choice(WORDS) for i in xrange(count))
+    parts = ['<html><head><style>p { margin: 0 }</style></head><body>']
+    for i in xrange(rnd.randint(3, 8)):
+        parts.append('<p>%s <a href="http://example.com/%d">%s</a> '
+                     '&amp; %s&nbsp;&hellip;</p>' % (text(40), i, text(2),
+                                                     text(20)))
+    parts.append('<ul>%s</ul>' % ''.join('<li>%s</li>' % text(8)
+                                         for i in xrange(5)))
+    parts.append('<table>%s</table>' % ''.join(
+        '<tr><td>%s</td><td>%s</td></tr>' % (text(2), text(4))
+        for i in xrange(6)))
+    parts.append('<blockquote><p>%s</p></blockquote>' % text(60))
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def main():
+    count = 200
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        handler = sys.argv[2]
+    else:
+        handler = get_mime_handler('text/html', key='view',
+                                   interactive=False)
+    config.set('general', 'render_cache_size', '0')
+    rnd = random.Random(0)
+    mails = [generate_html(rnd) for i in xrange(count)]
+    size = sum(len(mail) for mail in mails)
+    print '%d mails, %d KB of html' % (count, size / 1024)
+
+    start = time.time()
+    for mail in mails:
+        render.render_html(mail.decode('ascii'))
+    builtin = time.time() - start
+    print 'builtin: %7.1f ms, %5.2f ms per mail' % (builtin * 1000,
+                                                  builtin * 1000 / count)
+
+    if not handler:
+        print 'external: no text/html handler in mailcap, give one as ' \
+              'second argument'
+        return
+    start = time.time()
+    for mail in mails:
+        job = render.RenderJob(handler, mail, 'text/html', mail)
+        job.finish(render.render_external(handler, mail))
+    external = time.time() - start
+    print 'external: %7.1f ms, %5.2f ms per mail (%s)' % (
+        external * 1000, external * 1000 / count, handler)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""
+This file is part of alot.
+
+Alot is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Alot is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
+"""
+# Estimates the memory used per Thread and per Message with
+# sys.getsizeof, on a synthetic corpus in an in-memory index. Each object
+# is counted with its instance dict or slots and their direct values.
+# Objects shared between instances, like the DBManager or the thread a
+# message belongs to, are not counted.
+#
+# Objects with an instance dict are measured as well as slotted ones, so
+# the numbers of two revisions can be compared by running the script in
+# checkouts of both.
+#
+# usage: python bench/memory.py [messages]
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from alot.db import DBManager
+from alot.memorybackend import MemoryBackend, generate_corpus
+
+
+def object_size(obj, shared):
+    """returns the size of obj, its dict or slots and their values in
+    bytes, skipping objects whose id is in shared"""
+    size = sys.getsizeof(obj)
+    attributes = getattr(obj, '__dict__', None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+        values = attributes.values()
+    else:
+        values = [getattr(obj, name, None) for name in type(obj).__slots__]
+    for value in values:
+        if value is None or id(value) in shared:
+            continue
+        size += sys.getsizeof(value)
+        if isinstance(value, (set, frozenset, tuple, list)):
+            size += sum(sys.getsizeof(item) for item in value
+                        if id(item) not in shared)
+    return size
+
+
+def main():
+    count = 3000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    backend = MemoryBackend()
+    generate_corpus(backend, count, seed=1)
+    dbman = DBManager(backend=backend)
+    threads = dbman.get_threads_window('*', 0, count)
+    shared = set([id(dbman)])
+    size = sum(object_size(thread, shared) for thread in threads)
+    print '%d threads: %d bytes per thread' % (len(threads),
+                                               size / len(threads))
+
+    messages = [msg for thread in threads[:200]
+                for msg in thread.get_thread_tree().messages]
+    shared.update(id(thread) for thread in threads)
+    size = sum(object_size(msg, shared) for msg in messages)
+    print '%d messages: %d bytes per message' % (len(messages),
+                                                 size / len(messages))
+
+
+if __name__ == '__main__':
+    main()
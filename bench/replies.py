@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""
+This file is part of alot.
+
+Alot is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Alot is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
+"""
+# Times reply lookups in synthetic deep and wide threads of an in-memory
+# index: building the reply index of a thread, and asking get_replies_to
+# for every message, compared with the scan over all messages of the
+# thread that Thread used before it had the index.
+#
+# usage: python bench/replies.py [messages per thread]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from alot.db import DBManager
+from alot.memorybackend import MemoryBackend, generate_corpus
+
+
+def add_thread(backend, name, size, parent_of):
+    """adds a thread of size messages, message i replying to message
+    parent_of(i), and returns the id of its first message"""
+    for num in xrange(size):
+        headers = {'From': 'User %d <user%d@example.com>' % (num % 20,
+                                                             num % 20),
+                   'Subject': '%s thread' % name}
+        if num:
+            headers['In-Reply-To'] = '%s.%d' % (name, parent_of(num))
+        backend.add_message('%s.%d' % (name, num), headers,
+                            1300000000 + num * 60)
+    return '%s.0' % name
+
+
+def scan_replies(thread, msg):
+    """the lookup before the reply index: a scan over all messages"""
+    mid = msg.get_message_id()
+    messages = thread.get_messages()
+    for m in messages.keys():
+        if m.get_message_id() == mid:
+            return messages[m]
+    return None
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return (time.time() - start) * 1000
+
+
+def run(dbman, mid):
+    thread = dbman.get_thread(dbman.backend.find_message(mid).tid)
+    build = timed(thread.get_messages)
+    messages = thread.get_thread_tree().messages
+    index = timed(lambda: [thread.get_replies_to(m) for m in messages])
+    scan = timed(lambda: [scan_replies(thread, m) for m in messages])
+    print '%-5s %5d messages: build %7.1f ms, get_replies_to %7.1f ms, ' \
+          'scan %9.1f ms' % (mid.split('.')[0], len(messages), build,
+                             index, scan)
+
+
+def main():
+    size = 2000
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    backend = MemoryBackend()
+    generate_corpus(backend, 5000, seed=1)
+    deep = add_thread(backend, 'deep', size, lambda num: num - 1)
+    wide = add_thread(backend, 'wide', size, lambda num: 0)
+    dbman = DBManager(backend=backend)
+    run(dbman, deep)
+    run(dbman, wide)
+
+
+if __name__ == '__main__':
+    main()
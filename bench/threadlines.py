@@ -0,0 +1,69 @@
+#!/usr/bin/python
+"""
+This file is part of alot.
+
+Alot is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Alot is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with notmuch.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright (C) 2011 Patrick Totzke <patricktotzke@gmail.com>
+"""
+# Times a full repaint of a screen of threadlines, as when the focus
+# moves in a search buffer. urwid's canvas cache is cleared before each
+# repaint, so that only the caching done by the widgets themselves helps.
+#
+# usage: python bench/threadlines.py [lines] [columns]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import urwid
+
+from alot import widgets
+from alot.db import DBManager
+from alot.memorybackend import MemoryBackend, generate_corpus
+
+REPAINTS = 50
+
+
+def main():
+    count = 200
+    width = 160
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        width = int(sys.argv[2])
+    urwid.set_encoding('utf8')
+    backend = MemoryBackend()
+    generate_corpus(backend, count * 10, seed=1)
+    dbman = DBManager(backend=backend)
+    lines = [widgets.ThreadlineWidget(thread, dbman)
+             for thread in dbman.get_threads_window('*', 0, count)]
+
+    def repaint(focus):
+        for num, line in enumerate(lines):
+            line.render((width,), num == focus)
+
+    repaint(0)
+    start = time.time()
+    for num in xrange(REPAINTS):
+        urwid.CanvasCache.clear()
+        repaint(num % len(lines))
+    elapsed = (time.time() - start) / REPAINTS
+    print '%d lines at %d columns: %.2f ms per repaint' % (
+        len(lines), width, elapsed * 1000)
+
+
+if __name__ == '__main__':
+    main()